@@ -0,0 +1,202 @@
+# LLM を呼ぶルート（/game・/choose）の流量制御
+# 同時に LLM を呼ぶ数と待ち行列の長さに上限を設け、あふれた分はすぐに断る。
+# 断られた呼び出し側はローカルの代替処理（LLM を使わない選択肢・文章）に切り替える。
+# 先読み（/game で始める文章生成）は別枠で数え、プレイヤーを待たせる呼び出しの枠を奪わない。
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+# 同時に LLM を呼べる数
+MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "8"))
+# 空きを待てる数（これを超えたら即座に断る）
+MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "16"))
+# 1 セッションが同時に抱えられる数（先読みは含まない）
+MAX_PER_SESSION = int(os.getenv("LLM_MAX_PER_SESSION", "3"))
+# 先読みに使える数（全体・1 セッションあたり）
+MAX_SPECULATIVE = int(os.getenv("LLM_MAX_SPECULATIVE", "6"))
+MAX_SPECULATIVE_PER_SESSION = int(os.getenv("LLM_MAX_SPECULATIVE_PER_SESSION", "3"))
+# 待ち行列で待つ最大時間（秒）
+QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "3"))
+
+
+class Overloaded(Exception):
+    """混雑のため LLM 呼び出しを受け付けなかった。"""
+
+
+class Slot:
+    """
+    先読み 1 件分の枠。release() は何度呼んでもよい（最初の 1 回だけ返す）。
+    捨てたが呼び出しがまだ走っているものは detach() で枠を返し、
+    呼び出しが終わって release() されるまでは「切り離し中」として数える。
+    """
+
+    def __init__(self, release_fn: Callable[[], None], detach_fn: Optional[Callable[[int], None]] = None):
+        self._release_fn = release_fn
+        self._detach_fn = detach_fn  # 切り離し中の数を増減する（+1 / -1）
+        self._state = "held"  # held → released、または held → detached → released
+        self._lock = threading.Lock()
+
+    def release(self) -> None:
+        with self._lock:
+            if self._state == "held":
+                self._release_fn()
+            elif self._state == "detached" and self._detach_fn is not None:
+                self._detach_fn(-1)
+            self._state = "released"
+
+    def detach(self) -> None:
+        """枠は返すが、release() されるまで切り離し中として数える。"""
+        with self._lock:
+            if self._state != "held":
+                return
+            self._state = "detached"
+            if self._detach_fn is not None:
+                self._detach_fn(1)
+            self._release_fn()
+
+    def __enter__(self) -> "Slot":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class AdmissionController:
+    """
+    先着順の待ち行列つきセマフォ。
+    1 セッションが枠を占有しないよう、セッションごとの上限も設ける。
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT,
+        max_queue: int = MAX_QUEUE,
+        max_per_session: int = MAX_PER_SESSION,
+        queue_timeout: float = QUEUE_TIMEOUT,
+        max_speculative: int = MAX_SPECULATIVE,
+        max_speculative_per_session: int = MAX_SPECULATIVE_PER_SESSION,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_per_session = max_per_session
+        self.queue_timeout = queue_timeout
+        self.max_speculative = max_speculative
+        self.max_speculative_per_session = max_speculative_per_session
+        self.active = 0
+        self.speculative_active = 0
+        # 捨てた（枠は返した）が、呼び出しがまだ走っている先読みの数
+        self.speculative_detached = 0
+        self._speculative_per_session: Counter = Counter()
+        self._waiting: deque = deque()
+        self._per_session: Counter = Counter()  # 実行中 + 待機中
+        self._cond = threading.Condition()
+        self.admitted = 0
+        self.shed: Counter = Counter()  # 理由 → 断った数
+
+    def _shed(self, reason: str) -> None:
+        self.shed[reason] += 1
+        raise Overloaded(f"LLM 呼び出しを受け付けませんでした（{reason}）")
+
+    def _acquire(self, session_key: str, wait: bool) -> None:
+        with self._cond:
+            if self._per_session[session_key] >= self.max_per_session:
+                self._shed("session_limit")
+            if self.active < self.max_concurrent and not self._waiting:
+                self.active += 1
+                self._per_session[session_key] += 1
+                self.admitted += 1
+                return
+            if not wait:
+                self._shed("busy")
+            if len(self._waiting) >= self.max_queue:
+                self._shed("queue_full")
+
+            ticket = object()
+            self._waiting.append(ticket)
+            self._per_session[session_key] += 1
+            deadline = time.monotonic() + self.queue_timeout
+            admitted = False
+            try:
+                while not (self._waiting[0] is ticket and self.active < self.max_concurrent):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._shed("timeout")
+                    self._cond.wait(remaining)
+                self._waiting.popleft()
+                self.active += 1
+                self.admitted += 1
+                admitted = True
+            finally:
+                if not admitted:
+                    self._waiting.remove(ticket)
+                    self._release_session(session_key)
+                # 先頭が入れ替わったので、次の待機者にも確認させる
+                self._cond.notify_all()
+
+    @staticmethod
+    def _decrement(counter: Counter, session_key: str) -> None:
+        counter[session_key] -= 1
+        if counter[session_key] <= 0:
+            del counter[session_key]
+
+    def _release_session(self, session_key: str) -> None:
+        self._decrement(self._per_session, session_key)
+
+    def _release(self, session_key: str) -> None:
+        with self._cond:
+            self.active -= 1
+            self._release_session(session_key)
+            self._cond.notify_all()
+
+    def _release_speculative(self, session_key: str) -> None:
+        with self._cond:
+            self.speculative_active -= 1
+            self._decrement(self._speculative_per_session, session_key)
+
+    def _count_detached(self, delta: int) -> None:
+        with self._cond:
+            self.speculative_detached += delta
+
+    @contextmanager
+    def admit(self, session_key: str, wait: bool = True) -> Iterator[None]:
+        """
+        LLM 呼び出しの枠を確保する。確保できなければ Overloaded を送出する。
+        wait=False なら空きが無いときに待たずに断る。
+        """
+        self._acquire(session_key or "anonymous", wait)
+        try:
+            yield
+        finally:
+            self._release(session_key or "anonymous")
+
+    def admit_speculative(self, session_key: str) -> Slot:
+        """
+        先読みの枠を待たずに確保する。空きが無ければ Overloaded を送出する。
+        先読みを捨てたときは、呼び出しの完了を待たずに Slot.detach() で枠を返してよい
+        （呼び出しが終わるまでは snapshot() の speculative_detached に数える）。
+        """
+        session_key = session_key or "anonymous"
+        with self._cond:
+            if self._speculative_per_session[session_key] >= self.max_speculative_per_session:
+                self._shed("speculative_session_limit")
+            if self.speculative_active >= self.max_speculative:
+                self._shed("speculative_busy")
+            self.speculative_active += 1
+            self._speculative_per_session[session_key] += 1
+            self.admitted += 1
+        return Slot(lambda: self._release_speculative(session_key), self._count_detached)
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            return {
+                "active": self.active,
+                "speculative_active": self.speculative_active,
+                "speculative_detached": self.speculative_detached,
+                "queue_depth": len(self._waiting),
+                "admitted": self.admitted,
+                "shed": dict(self.shed),
+                "shed_total": sum(self.shed.values()),
+            }
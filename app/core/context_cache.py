@@ -0,0 +1,128 @@
+# 静的なシステムプロンプトのコンテキストキャッシュ
+# 毎回同じ指示文を送らずに済むよう、Gemini の cachedContents に一度だけ登録し、
+# 期限が切れる前に自動で登録し直す。
+#
+# 注意: cachedContents には最小トークン数がある（Gemini 2.x Flash で 1024）。
+# いまの SYSTEM_MSG・SCENE_RULES はこれより短いので、既定では登録せずにそのまま送る。
+# プロンプトが長くなれば（または CONTEXT_CACHE_MIN_TOKENS を下げれば）自動で使われる。
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+# キャッシュの有効期間（秒）
+CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+# 期限のこの秒数前になったら登録し直す
+REFRESH_MARGIN_SECONDS = 60
+# 登録に失敗したら、しばらくはキャッシュなしで送る（短すぎるプロンプトは登録できない等）
+FAILURE_BACKOFF_SECONDS = 600
+# CONTEXT_CACHE=0 でキャッシュを使わない（有り・無しの比較用）
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE", "1") != "0"
+# これより短いと見積もったプロンプトは登録しない（API 側で断られるため）
+MIN_CACHE_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "1024"))
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の大まかな見積もり（英数字は 4 文字で 1、それ以外は 1 文字で 1）。"""
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+
+class ContextCache:
+    """
+    (モデル名, キー) ごとに静的プロンプトのキャッシュハンドルを保持する。
+    create_fn(model, text, ttl_seconds) がハンドルを返す（REST ならキャッシュ名、
+    SDK ならキャッシュ済みの GenerativeModel など、呼び出し側で使えるものなら何でもよい）。
+    """
+
+    def __init__(
+        self,
+        create_fn: Callable[[str, str, int], Any],
+        ttl: int = CACHE_TTL_SECONDS,
+        enabled: bool = CONTEXT_CACHE_ENABLED,
+        clock: Callable[[], float] = time.time,
+        min_tokens: int = MIN_CACHE_TOKENS,
+    ):
+        self.create_fn = create_fn
+        self.ttl = ttl
+        self.enabled = enabled
+        self.clock = clock
+        self.min_tokens = min_tokens
+        self._handles: Dict[Tuple[str, str], Tuple[Any, float]] = {}
+        self._failed_until: Dict[Tuple[str, str], float] = {}
+        self._creating: Set[Tuple[str, str]] = set()  # 登録中のキー（同じキーは 1 つずつ）
+        self._lock = threading.Lock()
+        self.registrations = 0
+        self.skipped_small = 0
+        # "cached" / "uncached" ごとの計測値
+        self.stats = {
+            mode: {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "seconds": 0.0}
+            for mode in ("cached", "uncached")
+        }
+
+    def get(self, model: str, key: str, text: str) -> Optional[Any]:
+        """有効なハンドルを返す。使えなければ None（呼び出し側はプロンプトをそのまま送る）。"""
+        if not self.enabled:
+            return None
+        cache_key = (model, key)
+        with self._lock:
+            now = self.clock()
+            handle, expires_at = self._handles.get(cache_key, (None, 0.0))
+            if handle is not None and now < expires_at - REFRESH_MARGIN_SECONDS:
+                return handle
+            if now < self._failed_until.get(cache_key, 0.0):
+                return None
+            if estimate_tokens(text) < self.min_tokens:
+                self.skipped_small += 1
+                return None
+            if cache_key in self._creating:
+                # 他のスレッドが登録中。期限内の古いハンドルがあればそれを使う
+                return handle if now < expires_at else None
+            self._creating.add(cache_key)
+
+        # 登録は API 呼び出しなので、ロックの外で行う（record() などを止めない）
+        try:
+            handle = self.create_fn(model, text, self.ttl)
+        except Exception as e:
+            print(f"Context Cache Error ({model}/{key}): {e}")
+            with self._lock:
+                self._creating.discard(cache_key)
+                self._handles.pop(cache_key, None)
+                self._failed_until[cache_key] = self.clock() + FAILURE_BACKOFF_SECONDS
+            return None
+
+        with self._lock:
+            self._creating.discard(cache_key)
+            self._handles[cache_key] = (handle, now + self.ttl)
+            self.registrations += 1
+        return handle
+
+    def invalidate(self, model: str, key: str) -> None:
+        """サーバー側で期限切れ・削除されていたときに呼ぶ。次回登録し直す。"""
+        with self._lock:
+            self._handles.pop((model, key), None)
+
+    def record(self, cached: bool, prompt_tokens: int, cached_tokens: int, seconds: float) -> None:
+        """1 回の呼び出しの入力トークン数と応答時間を記録する。"""
+        with self._lock:
+            stats = self.stats["cached" if cached else "uncached"]
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["cached_tokens"] += cached_tokens
+            stats["seconds"] += seconds
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            result: Dict[str, Any] = {
+                "registrations": self.registrations,
+                "skipped_small": self.skipped_small,
+            }
+            for mode, stats in self.stats.items():
+                calls = stats["calls"] or 1
+                result[mode] = {
+                    **stats,
+                    # キャッシュ分は課金対象の入力トークンから除く
+                    "billed_prompt_tokens_per_call": (stats["prompt_tokens"] - stats["cached_tokens"]) / calls,
+                    "seconds_per_call": stats["seconds"] / calls,
+                }
+            return result
@@ -2,24 +2,72 @@
 # 【応答が遅いから変える】
 import os
 import json
+import random
 import re
+import time
+import datetime
+from functools import lru_cache
 from typing import Any
 import google.generativeai as genai
 from dotenv import load_dotenv
 from .data_manager import load_quotes
+from .model_router import ModelRouter
+from .context_cache import ContextCache
 
 load_dotenv()
 
 api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
+if api_key:
+    genai.configure(api_key=api_key)
+elif os.getenv("SCENE_BACKEND", "gemini") != "local":
+    # SCENE_BACKEND=local（オフライン）なら LLM を呼ばないので API キーは要らない
     raise RuntimeError("Missing GEMINI_API_KEY")
 
-genai.configure(api_key=api_key)
-
 MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-lite")
+RICH_MODEL_NAME = "gemini-2.5-flash-preview-09-2025"
+
+# 振り分け対象のモデル（高品質・重い順）。GEMINI_MODELS=a,b,... で上書きできる
+ROUTED_MODELS = [
+    m.strip()
+    for m in os.getenv("GEMINI_MODELS", f"{RICH_MODEL_NAME},{MODEL_NAME}").split(",")
+    if m.strip()
+]
+
+# 計測前の想定応答時間（秒）。/game の選択肢は軽いモデルから始め、
+# 重いモデルは RETRY_AFTER ごとの試しで許容時間に収まると分かってから使う
+LATENCY_PRIORS = {
+    "options": {RICH_MODEL_NAME: 8.0, MODEL_NAME: 2.0},
+    "scene": {RICH_MODEL_NAME: 6.0, MODEL_NAME: 3.0},
+}
+
+# /game と /choose で共有するモデル振り分け
+model_router = ModelRouter(ROUTED_MODELS, priors=LATENCY_PRIORS)
+
+# モデル名 → GenerativeModel（作成は 1 回だけ）
+_models: dict = {}
+
 
-# モデルを作る
-model = genai.GenerativeModel(MODEL_NAME)
+def _get_model(name: str) -> genai.GenerativeModel:
+    if name not in _models:
+        _models[name] = genai.GenerativeModel(name)
+    return _models[name]
+
+
+def _create_cached_model(name: str, text: str, ttl: int) -> genai.GenerativeModel:
+    """text をシステム指示として cachedContents に登録し、それを使うモデルを返す。"""
+    # 古い SDK には caching が無いので、ここで import する（失敗時はキャッシュなしで送る）
+    from google.generativeai import caching
+
+    cached = caching.CachedContent.create(
+        model=f"models/{name}",
+        system_instruction=text,
+        ttl=datetime.timedelta(seconds=ttl),
+    )
+    return genai.GenerativeModel.from_cached_content(cached_content=cached)
+
+
+# SYSTEM_MSG のキャッシュ（モデルごと）
+options_cache = ContextCache(_create_cached_model)
 
 # LLM に渡す引用の最大数（多いほど遅くなるので絞る）
 MAX_QUOTES_PER_CALL = 12
@@ -31,9 +79,10 @@ SYSTEM_MSG = SYSTEM_MSG = """
   プレイヤーに提示する「次の選択肢 3 個」を JSON 形式で返してください。
 
   【最重要ルール】
-  - 各選択肢の "text" は、【必ず CSV データ内の quote の text をそのまま使用してください】
-  - セリフを要約・言い換え・創作してはいけません
-  - text は CSV に含まれる文章と 完全一致させてください
+  - 引用データは 1 行 1 件の「quote_id|work_id|mood|text」形式です
+  - 各選択肢は、引用データの中から選んだ引用の "quote_id" だけで指定してください
+  - セリフを要約・言い換え・創作してはいけません（text は返さないでください）
+  - 3 つの選択肢は、なるべく異なる work_id の引用から選んでください
 
   【感情に関するルール】
   - 3つの選択肢の next_mood は、【可能な限りすべて異なる感情】にしてください
@@ -47,19 +96,9 @@ SYSTEM_MSG = SYSTEM_MSG = """
   【指定可能な next_mood】
   "hopeful", "angry", "melancholic", "anxious", "calm"
 
-  【work_id について】
-  - 各選択肢の "work_id" は、その text が元になっている引用の work_id を入れてください
-
   出力は必ず次の形式の JSON だけにしてください。
-  各 options[i] の "work_id" には、引用に対応する work_id を 1 つ入れてください。
-
-  {
-    "options": [
-      {"id": 1, "text": "CSV内の引用文そのまま", "next_mood": "hope",   "work_id": "hashire"},
-      {"id": 2, "text": "CSV内の引用文そのまま", "next_mood": "despair","work_id": "kokoro"},
-      {"id": 3, "text": "CSV内の引用文そのまま", "next_mood": "neutral","work_id": "lemon"}
-    ]
-  }
+
+  {"options": [{"quote_id": 2, "next_mood": "hopeful"}, {"quote_id": 17, "next_mood": "melancholic"}, {"quote_id": 31, "next_mood": "calm"}]}
 """.strip()
 
 
@@ -93,47 +132,104 @@ def _extract_text(response: Any) -> str:
     return "".join(pieces).strip()
 
 
-def generate_options_from_csv(current_mood: str):
+# プロンプトに載せる列（出典・権利表記などはモデルに不要なので送らない）
+COMPACT_COLUMNS = ("quote_id", "work_id", "mood", "text")
+# /game に出す選択肢の数
+OPTION_COUNT = 3
+
+
+@lru_cache(maxsize=1)
+def _compact_quotes():
     """
-    現在の mood と CSV の引用データから、
-    次の選択肢候補3つを生成して返す。
+    引用データから、次の 2 つを 1 回だけ作っておく。
+    - quote_id → 引用（モデルが返した quote_id を展開する用）
+    - mood → 「quote_id|work_id|mood|text」形式の行のリスト（プロンプト用）
     """
     df = load_quotes()
-
-    # mood 列があれば優先してフィルタ
-    if "mood" in df.columns:
-        df_mood = df[df["mood"] == current_mood]
-        if df_mood.empty:
-            df_mood = df  # 該当が無ければ全体から
-    else:
-        df_mood = df
+    quotes_by_id = {}
+    lines_by_mood = {}
+    all_lines = []
+    for row in df.to_dict(orient="records"):
+        quote = {col: str(row.get(col, "")) for col in COMPACT_COLUMNS}
+        quotes_by_id[quote["quote_id"]] = quote
+        # 区切り文字・改行が本文に混ざると表が崩れるので置き換える
+        text = quote["text"].replace("|", "｜").replace("\n", " ")
+        line = f'{quote["quote_id"]}|{quote["work_id"]}|{quote["mood"]}|{text}'
+        lines_by_mood.setdefault(quote["mood"], []).append(line)
+        all_lines.append(line)
+    return quotes_by_id, lines_by_mood, all_lines
+
+
+def _select_quotes(current_mood: str) -> list:
+    """mood で絞り込み、LLM に渡す引用の行を最大 MAX_QUOTES_PER_CALL 件選ぶ。"""
+    _, lines_by_mood, all_lines = _compact_quotes()
+    lines = lines_by_mood.get(current_mood) or all_lines  # 該当が無ければ全体から
 
     # LLM に渡す行数を絞る（多いとその分トークン数が増えて遅くなる）
-    if len(df_mood) > MAX_QUOTES_PER_CALL:
-        df_mood = df_mood.sample(MAX_QUOTES_PER_CALL, random_state=None)
-
-    quotes_list = df_mood.to_dict(orient="records")
-
-    user_msg = f"""
-現在の mood: {current_mood}
-
-以下はゲームで利用できる引用データの一部です。
-この mood に近いものを優先して参考にしながら、
-プレイヤーに提示する「次の選択肢 3 個」を考えてください。
-
-CSV データ (JSON 形式):
-{json.dumps(quotes_list, ensure_ascii=False)}
-""".strip()
-
-    contents = [
-        {"role": "user", "parts": [{"text": SYSTEM_MSG}]},
-        {"role": "user", "parts": [{"text": user_msg}]},
-    ]
+    if len(lines) > MAX_QUOTES_PER_CALL:
+        lines = random.sample(lines, MAX_QUOTES_PER_CALL)
+    return lines
 
-    rsp = model.generate_content(contents=contents)
-    raw = _extract_text(rsp)
 
-    # 応答から JSON 部分だけ抜き出す
+def _build_contents(current_mood: str, quote_lines: list, include_system: bool = True) -> list:
+    """
+    選択肢生成のプロンプトを組み立てる。
+    SYSTEM_MSG をキャッシュ済みなら include_system=False で可変部分だけにする。
+    """
+    user_msg = (
+        f"現在の mood: {current_mood}\n\n"
+        "以下はゲームで利用できる引用データの一部です。\n"
+        "この mood に近いものを優先して参考にしながら、\n"
+        "プレイヤーに提示する「次の選択肢 3 個」を quote_id で選んでください。\n\n"
+        "quote_id|work_id|mood|text\n"
+        + "\n".join(quote_lines)
+    )
+
+    contents = [{"role": "user", "parts": [{"text": user_msg}]}]
+    if include_system:
+        contents.insert(0, {"role": "user", "parts": [{"text": SYSTEM_MSG}]})
+    return contents
+
+
+def _expand_options(options: list, current_mood: str = "neutral") -> list:
+    """
+    モデルが返した quote_id を、手元の引用データで text・work_id に展開する。
+    重複・存在しない quote_id は捨て、足りない分は generate_local_options で補って
+    必ず OPTION_COUNT 個にする（game.html は 3 つの選択肢を前提にしている）。
+    """
+    quotes_by_id, _, _ = _compact_quotes()
+    expanded = []
+    for opt in options:
+        quote = quotes_by_id.get(str(opt.get("quote_id", "")).strip())
+        if quote is None or any(e["quote_id"] == quote["quote_id"] for e in expanded):
+            continue  # 存在しない・重複した quote_id は捨てる
+        expanded.append({
+            "id": len(expanded) + 1,
+            "quote_id": quote["quote_id"],
+            "text": quote["text"],
+            "next_mood": opt.get("next_mood") or quote["mood"],
+            "work_id": quote["work_id"],
+        })
+        if len(expanded) == OPTION_COUNT:
+            break
+
+    if not expanded:
+        raise ValueError(
+            "Gemini 応答に有効な quote_id がありません:\n"
+            + json.dumps(options, ensure_ascii=False)
+        )
+    if len(expanded) < OPTION_COUNT:
+        for local in generate_local_options(current_mood):
+            if any(e["quote_id"] == local["quote_id"] for e in expanded):
+                continue
+            expanded.append({**local, "id": len(expanded) + 1})
+            if len(expanded) == OPTION_COUNT:
+                break
+    return expanded
+
+
+def _parse_options(raw: str) -> list:
+    """応答テキストから JSON 部分だけ抜き出し、options 配列を返す。"""
     json_match = re.search(r"\{[\s\S]*\}", raw)
     if not json_match:
         raise ValueError("Gemini から JSON を抽出できませんでした:\n" + raw)
@@ -148,3 +244,67 @@ CSV データ (JSON 形式):
         )
 
     return options
+
+
+def generate_local_options(current_mood: str) -> list:
+    """
+    LLM を使わずに CSV から選択肢を 3 つ選ぶ（混雑時・障害時の代替）。
+    作品が重ならず、なるべく現在と違う mood になるように選ぶ。
+    """
+    df = load_quotes()
+    if "mood" in df.columns:
+        others = df[df["mood"] != current_mood]
+        if len(others) >= 3:
+            df = others
+    df = df.sample(frac=1)
+
+    options = []
+    used_works = set()
+    for row in df.to_dict(orient="records"):
+        if row.get("work_id") in used_works:
+            continue
+        used_works.add(row.get("work_id"))
+        options.append({
+            "id": len(options) + 1,
+            "quote_id": str(row.get("quote_id", "")),
+            "text": row["text"],
+            "next_mood": row.get("mood", "calm"),
+            "work_id": row.get("work_id"),
+        })
+        if len(options) == OPTION_COUNT:
+            break
+    return options
+
+
+def generate_options_from_csv(current_mood: str):
+    """
+    現在の mood と CSV の引用データから、
+    次の選択肢候補3つを生成して返す。
+    """
+    quote_lines = _select_quotes(current_mood)
+
+    def generate(name):
+        cached_model = options_cache.get(name, "options", SYSTEM_MSG)
+        model = cached_model or _get_model(name)
+        contents = _build_contents(current_mood, quote_lines, include_system=cached_model is None)
+
+        start = time.monotonic()
+        try:
+            rsp = model.generate_content(contents=contents)
+        except Exception:
+            if cached_model is not None:
+                # 期限切れ・削除されていたら次回登録し直す
+                options_cache.invalidate(name, "options")
+            raise
+
+        usage = getattr(rsp, "usage_metadata", None)
+        options_cache.record(
+            cached=cached_model is not None,
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            cached_tokens=getattr(usage, "cached_content_token_count", 0) or 0,
+            seconds=time.monotonic() - start,
+        )
+        return rsp
+
+    rsp = model_router.call("options", generate)
+    return _expand_options(_parse_options(_extract_text(rsp)), current_mood)
@@ -0,0 +1,228 @@
+# オフライン用のローカル文章生成（文字 n-gram のマルコフ連鎖）
+# ネットワークが無くても /choose の場面を数ミリ秒で作れるようにする。
+# 確率表はあらかじめバイナリに書き出し、mmap で読み込む。
+# 作品の純度（その作品以外のモチーフを出さない）を守るため、確率表は作品ごとに作る。
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import random
+import re
+import struct
+import threading
+from array import array
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, Optional
+
+from .data_manager import DATA_DIR, load_quotes
+
+# 作品を指定しないとき（未知の作品 ID も）の確率表。作品ごとの表は markov-<作品 ID>.bin
+TABLE_PATH = DATA_DIR / "markov.bin"
+MAGIC = b"MKV1"
+# 直前の ORDER 文字から次の 1 文字を選ぶ
+ORDER = 3
+
+MIN_CHARS = 150
+MAX_CHARS = 200
+# 選ばれた台詞として場面の冒頭に入れる最大文字数（長い台詞だけで上限を超えないように）
+MAX_QUOTE_CHARS = 60
+
+# 学習データから取り除くもの（あらすじの HTML タグ・空白・改行）
+_CLEANUP = re.compile(r"<[^>]+>|\s+")
+
+
+def _clean(text: str) -> str:
+    return _CLEANUP.sub("", text)
+
+
+def _corpus(extra_texts: Iterable[str], work: Optional[str] = None) -> List[str]:
+    """引用データ（work を指定すればその作品の分だけ）と extra_texts を学習データにする。"""
+    texts: List[str] = []
+    try:
+        quotes = load_quotes()
+        if work is not None:
+            quotes = quotes[quotes["work_id"] == work]
+        texts.extend(quotes["text"].astype(str).tolist())
+    except Exception as e:
+        print(f"Local Generator Corpus Error: {e}")
+    texts.extend(extra_texts)
+    return [t for t in (_clean(t) for t in texts) if len(t) > ORDER]
+
+
+def _corpus_hash(texts: List[str]) -> str:
+    return hashlib.sha256("\n".join(texts).encode("utf-8")).hexdigest()[:16]
+
+
+def compile_table(texts: List[str], path=TABLE_PATH) -> None:
+    """
+    n-gram の出現数を数えて確率表を書き出す。
+    形式: MAGIC | ヘッダ長(uint32) | ヘッダ JSON | 次の文字(uint32[]) | 累積出現数(uint32[])
+    ヘッダには文脈 → 配列上の範囲 [start, end) と、文の書き出しに使える文脈を持つ。
+    """
+    counts: Dict[str, Counter] = defaultdict(Counter)
+    starts = set()
+    for text in texts:
+        # 文の区切りごとに書き出し候補を集める
+        for i in range(len(text) - ORDER):
+            ctx = text[i:i + ORDER]
+            counts[ctx][text[i + ORDER]] += 1
+            if i == 0 or text[i - 1] == "。":
+                starts.add(ctx)
+
+    chars = array("I")
+    cumulative = array("I")
+    contexts = {}
+    for ctx in sorted(counts):
+        start = len(chars)
+        total = 0
+        for ch, n in sorted(counts[ctx].items()):
+            total += n
+            chars.append(ord(ch))
+            cumulative.append(total)
+        contexts[ctx] = [start, len(chars)]
+
+    header = json.dumps(
+        {
+            "order": ORDER,
+            "corpus": _corpus_hash(texts),
+            "size": len(chars),
+            "contexts": contexts,
+            "starts": sorted(starts),
+        },
+        ensure_ascii=False,
+    ).encode("utf-8")
+    # 配列を 4 バイト境界に揃える
+    header += b" " * (-(len(MAGIC) + 4 + len(header)) % 4)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(chars.tobytes())
+        f.write(cumulative.tobytes())
+    os.replace(tmp, path)
+
+
+class _Table:
+    """compile_table で書き出した確率表を mmap で読む。"""
+
+    def __init__(self, mm: mmap.mmap, header: Dict, offset: int):
+        size = header["size"]
+        view = memoryview(mm)
+        self._mm = mm
+        self.chars = view[offset:offset + 4 * size].cast("I")
+        self.cumulative = view[offset + 4 * size:offset + 8 * size].cast("I")
+        self.contexts = header["contexts"]
+        self.starts = header["starts"] or list(self.contexts)
+
+    @classmethod
+    def open(cls, path, expected_corpus: Optional[str]) -> Optional["_Table"]:
+        """確率表を開く。無い・形式が違う・学習データが変わっていれば None。"""
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(MAGIC)] != MAGIC:
+            mm.close()
+            return None
+
+        (header_len,) = struct.unpack_from("<I", mm, len(MAGIC))
+        offset = len(MAGIC) + 4
+        header = json.loads(bytes(mm[offset:offset + header_len]).decode("utf-8"))
+        if header["order"] != ORDER or (expected_corpus and header["corpus"] != expected_corpus):
+            mm.close()
+            return None
+        return cls(mm, header, offset + header_len)
+
+    def next_char(self, ctx: str, rng: random.Random) -> Optional[str]:
+        span = self.contexts.get(ctx)
+        if span is None:
+            return None
+        start, end = span
+        r = rng.randrange(self.cumulative[end - 1])
+        idx = bisect.bisect_right(self.cumulative, r, start, end)
+        return chr(self.chars[idx])
+
+
+class LocalSceneGenerator:
+    """
+    引用データとあらすじ（works: 作品 ID → その作品の文章）から学習した確率表で場面を生成する。
+    作品ごとにその作品の引用・文章だけで確率表を作り、作品を指定しないときは全作品の表を使う。
+    確率表は初回利用時に読み込み、学習データが変わっていれば作り直す。
+    """
+
+    def __init__(self, works: Optional[Mapping[str, Iterable[str]]] = None, path=TABLE_PATH):
+        self.works = {work: list(texts) for work, texts in (works or {}).items()}
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._tables: Dict[Optional[str], _Table] = {}
+
+    def table_path(self, work: Optional[str]) -> Path:
+        if work is None:
+            return self.path
+        return self.path.with_name(f"{self.path.stem}-{work}{self.path.suffix}")
+
+    def _load(self, work: Optional[str]) -> _Table:
+        if work is None:
+            texts = _corpus(t for texts in self.works.values() for t in texts)
+        else:
+            texts = _corpus(self.works[work], work)
+        path = self.table_path(work)
+        expected = _corpus_hash(texts)
+        table = _Table.open(path, expected)
+        if table is None:
+            compile_table(texts, path)
+            table = _Table.open(path, expected)
+            if table is None:
+                raise RuntimeError(f"確率表を読み込めませんでした: {path}")
+        return table
+
+    def _table(self, work: Optional[str]) -> _Table:
+        if work not in self.works:
+            work = None  # 未知の作品は全作品の表で
+        with self._lock:
+            if work not in self._tables:
+                self._tables[work] = self._load(work)
+            return self._tables[work]
+
+    def generate(
+        self,
+        chosen_text: str = "",
+        work: Optional[str] = None,
+        rng: Optional[random.Random] = None,
+        min_chars: int = MIN_CHARS,
+        max_chars: int = MAX_CHARS,
+    ) -> str:
+        """
+        作品 work の確率表で min_chars〜max_chars 文字（改行を除く）の場面を返す。
+        /choose の LLM と同じく、句点（。）の後には必ず改行を入れる（末尾の句点を除く）。
+        """
+        table = self._table(work)
+        rng = rng or random
+
+        quote = _clean(chosen_text).rstrip("。")
+        if len(quote) > MAX_QUOTE_CHARS:
+            quote = quote[:MAX_QUOTE_CHARS - 1] + "…"
+        out = list(f"メロスは「{quote}」と叫んだ。") if quote else []
+        while len(out) < max_chars:
+            if not out or out[-1] == "。" or len(out) < ORDER:
+                out.extend(rng.choice(table.starts))
+                continue
+            ch = table.next_char("".join(out[-ORDER:]), rng)
+            if ch is None:
+                # 続きが無い文脈に来たら文を閉じる
+                ch = "。"
+            out.append(ch)
+            if ch == "。" and len(out) >= min_chars:
+                break
+
+        text = "".join(out[:max_chars])
+        if not text.endswith("。"):
+            # 上限で切れたら最後の文末まで戻す（戻りすぎるなら句点で閉じる）
+            last = text.rfind("。")
+            text = text[:last + 1] if last + 1 >= min_chars else text[:max_chars - 1] + "。"
+        return text.replace("。", "。\n").rstrip("\n")
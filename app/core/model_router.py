@@ -0,0 +1,188 @@
+# 複数の Gemini モデルの振り分け
+# 呼び出しの種類ごと・モデルごとに応答時間・エラー率の指数移動平均（EWMA）を記録し、
+# 呼び出しの種類ごとの許容時間に収まるモデルを選ぶ。
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 呼び出しの種類 → 許容する応答時間（秒）
+CALL_BUDGETS: Dict[str, float] = {
+    "options": 5.0,  # /game の選択肢生成
+    "scene": 8.0,    # /choose の文章生成（requests の timeout=10 より短く）
+}
+DEFAULT_BUDGET = 8.0
+
+# EWMA の重み（大きいほど直近の結果を重視する）
+EWMA_ALPHA = 0.3
+# これを超えたエラー率のモデルは一時的に使わない
+MAX_ERROR_RATE = 0.5
+# 遅い・不調で使わなくなったモデルを再び試すまでの時間（秒）
+RETRY_AFTER = 30.0
+# 試しの呼び出しが戻らないとき、この秒数で打ち切ったとみなして次の試しを許す
+PROBE_TIMEOUT = 15.0
+# 同時呼び出し（プレイヤーを待たせるもの）がこの数を超えるごとに、1 段軽いモデルから選ぶ
+DEGRADE_PER_INFLIGHT = 4
+
+
+class ModelStats:
+    """1 モデル・1 呼び出し種類分の統計。"""
+
+    def __init__(self, name: str, latency: Optional[float] = None, now: float = 0.0):
+        self.name = name
+        self.latency = latency  # 未計測なら None（事前値があればそれ）
+        self.error_rate = 0.0
+        self.last_failure = 0.0
+        self.last_used = now
+        self.probe_started: Optional[float] = None  # 試しの呼び出し中なら開始時刻
+        self.calls = 0
+
+    def to_dict(self) -> Dict:
+        return {
+            "latency": self.latency,
+            "error_rate": round(self.error_rate, 3),
+            "calls": self.calls,
+            "probing": self.probe_started is not None,
+        }
+
+
+class ModelRouter:
+    """
+    models は高品質（重い）順に並べる。
+    各呼び出しでは、許容時間に収まり、エラー率が低いモデルのうち最も高品質なものを選ぶ。
+    同時呼び出しが多いときは軽いモデルへ段階的に落とす。
+    先読みの呼び出し（speculative=True）は数えない（プレイヤー 1 人でも 3 件同時に走るため）。
+
+    priors は {呼び出しの種類: {モデル名: 想定応答時間}}。
+    計測前から許容時間を超えると分かっているモデルを、最初から選ばないようにする
+    （RETRY_AFTER 経つと 1 回だけ試し、実測値で置き換える）。
+    """
+
+    def __init__(
+        self,
+        models: List[str],
+        budgets: Optional[Dict[str, float]] = None,
+        alpha: float = EWMA_ALPHA,
+        clock: Callable[[], float] = time.monotonic,
+        priors: Optional[Dict[str, Dict[str, float]]] = None,
+    ):
+        if not models:
+            raise ValueError("ModelRouter には 1 つ以上のモデルが必要です")
+        self.models = list(dict.fromkeys(models))
+        self.budgets = dict(CALL_BUDGETS if budgets is None else budgets)
+        self.alpha = alpha
+        self.clock = clock
+        self.priors = priors or {}
+        self.stats: Dict[Tuple[str, str], ModelStats] = {}
+        self.inflight = 0              # プレイヤーを待たせている呼び出しの数
+        self.speculative_inflight = 0  # 先読みの呼び出しの数（モデル選択には使わない）
+        self._lock = threading.Lock()
+
+    def _stats(self, call_type: str, model: str) -> ModelStats:
+        key = (call_type, model)
+        if key not in self.stats:
+            prior = self.priors.get(call_type, {}).get(model)
+            # 事前値は「いま計測した」ものとして扱い、RETRY_AFTER までは試さない
+            self.stats[key] = ModelStats(model, prior, self.clock() if prior is not None else 0.0)
+        return self.stats[key]
+
+    def _probing(self, stats: ModelStats, now: float) -> bool:
+        return stats.probe_started is not None and now - stats.probe_started < PROBE_TIMEOUT
+
+    def choose(self, call_type: str) -> str:
+        """call_type の許容時間に合うモデル名を返す。"""
+        budget = self.budgets.get(call_type, DEFAULT_BUDGET)
+        with self._lock:
+            now = self.clock()
+            start = min(self.inflight // DEGRADE_PER_INFLIGHT, len(self.models) - 1)
+            candidates = [self._stats(call_type, name) for name in self.models[start:]]
+
+            chosen = None
+            reason = "budget"
+            for stats in candidates:
+                healthy = stats.error_rate <= MAX_ERROR_RATE
+                fast = stats.latency is None or stats.latency <= budget
+                if healthy and fast:
+                    chosen = stats
+                    break
+                # 不調・遅いモデルは、しばらく経ったら 1 回だけ試す（回復したかを確かめる）
+                since = now - (stats.last_failure if not healthy else stats.last_used)
+                if since >= RETRY_AFTER and not self._probing(stats, now):
+                    stats.probe_started = now
+                    chosen = stats
+                    reason = "probe"
+                    break
+
+            if chosen is None:
+                healthy = [s for s in candidates if s.error_rate <= MAX_ERROR_RATE]
+                if healthy:
+                    # どれも許容時間を超えているなら、いちばん速いもの
+                    chosen = min(healthy, key=lambda s: s.latency)
+                    reason = "fastest"
+                else:
+                    # すべて不調なら最も軽いモデル
+                    chosen = candidates[-1]
+                    reason = "lightest"
+
+        logger.info(
+            "model route: call=%s model=%s reason=%s inflight=%d budget=%.1fs",
+            call_type, chosen.name, reason, self.inflight, budget,
+        )
+        return chosen.name
+
+    def record(self, call_type: str, model: str, latency: float, ok: bool) -> None:
+        """1 回の呼び出し結果を EWMA に反映する。"""
+        with self._lock:
+            stats = self._stats(call_type, model)
+            stats.calls += 1
+            stats.probe_started = None
+            stats.last_used = self.clock()
+            if stats.latency is None or stats.calls == 1:
+                # 事前値は最初の実測値で置き換える
+                stats.latency = latency
+            else:
+                stats.latency += self.alpha * (latency - stats.latency)
+            stats.error_rate += self.alpha * ((0.0 if ok else 1.0) - stats.error_rate)
+            if not ok:
+                stats.last_failure = self.clock()
+
+    def call(self, call_type: str, fn: Callable[[str], T], speculative: bool = False) -> T:
+        """
+        モデルを選んで fn(model_name) を実行し、結果を記録する。
+        speculative=True の呼び出しは、軽いモデルへ落とす判断の同時呼び出し数に含めない。
+        """
+        model = self.choose(call_type)
+        self._count_inflight(speculative, 1)
+        start = self.clock()
+        try:
+            result = fn(model)
+        except Exception:
+            self.record(call_type, model, self.clock() - start, ok=False)
+            raise
+        else:
+            self.record(call_type, model, self.clock() - start, ok=True)
+            return result
+        finally:
+            self._count_inflight(speculative, -1)
+
+    def _count_inflight(self, speculative: bool, delta: int) -> None:
+        with self._lock:
+            if speculative:
+                self.speculative_inflight += delta
+            else:
+                self.inflight += delta
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            models: Dict[str, Dict] = {}
+            for (call_type, name), stats in self.stats.items():
+                models.setdefault(call_type, {})[name] = stats.to_dict()
+            return {
+                "inflight": self.inflight,
+                "speculative_inflight": self.speculative_inflight,
+                "models": models,
+            }
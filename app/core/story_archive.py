@@ -0,0 +1,273 @@
+# 完成した物語のアーカイブ（内容アドレス方式・共有辞書圧縮）
+# /ending で完成した物語をハッシュ名で保存し、同じ物語は 1 回だけ保存する。
+# 圧縮した本文と索引は 1 つの SQLite ファイルに入れる（1 物語 1 ファイルだと、
+# 数十バイトの物語でも 1 ブロック + 1 inode を使ってしまうため）。
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Dict, List, Optional
+
+from .data_manager import DATA_DIR, load_quotes
+
+ARCHIVE_DIR = DATA_DIR / "stories"
+# 本文（圧縮済み）と索引。実行時に作られる（リポジトリには含めない）
+DB_PATH = ARCHIVE_DIR / "archive.sqlite3"
+# 共有辞書：リポジトリに含める固定のファイル。実行時には作り直さない
+# （作り直すと既存の物語が展開できなくなるので、各物語に辞書の ID を記録しておく）
+ZDICT_PATH = DATA_DIR / "story_zdict.bin"
+
+# zlib の辞書はウィンドウサイズ（32KB）までしか効かない
+ZDICT_MAX_BYTES = 32 * 1024
+# 辞書の末尾ほど一致しやすいので、頻出語はここに置く
+ZDICT_COMMON_PHRASES = [
+    "メロスは",
+    "セリヌンティウス",
+    "。\n\n",
+    "。\n",
+    "友との約束",
+    "走れメロス",
+    "檸檬",
+    "こころ",
+    "注文の多い料理店",
+    '{"story": ["',
+]
+
+# 一覧 API の 1 ページの件数
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# ハッシュ名の形式（パスに使う前に必ず確認する）
+_STORY_ID_PATTERN = re.compile(r"^[0-9a-f]{16}$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    seq INTEGER PRIMARY KEY,      -- 追加順
+    id TEXT NOT NULL UNIQUE,      -- 本文のハッシュ名
+    mood TEXT NOT NULL,
+    works TEXT NOT NULL,          -- 作品 ID の JSON 配列
+    zdict_id TEXT NOT NULL,       -- 圧縮に使った辞書
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stories_by_mood ON stories (mood, seq);
+-- 作品での絞り込み用（1 物語に複数の作品）
+CREATE TABLE IF NOT EXISTS story_works (
+    work TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    mood TEXT NOT NULL,
+    PRIMARY KEY (work, seq)
+);
+CREATE INDEX IF NOT EXISTS story_works_by_mood ON story_works (mood, work, seq);
+-- 絞り込みごとの件数（一覧のたびに数えないため）。絞り込まない条件は '' で表す
+CREATE TABLE IF NOT EXISTS story_counts (
+    mood TEXT NOT NULL,
+    work TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (mood, work)
+);
+"""
+
+_lock = threading.Lock()
+_zdict: Optional[bytes] = None
+_zdict_id: Optional[str] = None
+_conn: Optional[sqlite3.Connection] = None
+
+
+class ArchiveDictionaryError(RuntimeError):
+    """物語を圧縮したときの辞書が手元に無い（展開できない）。"""
+
+
+def is_valid_story_id(digest: str) -> bool:
+    return bool(_STORY_ID_PATTERN.match(digest or ""))
+
+
+def story_hash(story: List[str]) -> str:
+    """物語本文から 16 桁のハッシュ名を作る（data/stories/ の既存ファイル名と同じ形式）。"""
+    canonical = json.dumps(story, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+def build_zdict() -> bytes:
+    """
+    引用データと data/stories/ の物語から共有辞書を作る。
+    ZDICT_PATH を作り直すときだけ使う（作り直すと辞書の ID が変わり、
+    それまでに保存した物語は ArchiveDictionaryError で読めなくなる）。
+    """
+    samples: List[str] = []
+    for path in sorted(ARCHIVE_DIR.glob("*.json")):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                samples.extend(json.load(f).get("story", []))
+        except (OSError, ValueError):
+            continue
+    samples.extend(load_quotes()["text"].astype(str).tolist())
+    samples.extend(ZDICT_COMMON_PHRASES)
+
+    data = "".join(samples).encode("utf-8")
+    return data[-ZDICT_MAX_BYTES:]
+
+
+def _get_zdict() -> bytes:
+    global _zdict, _zdict_id
+    if _zdict is None:
+        if not ZDICT_PATH.exists():
+            raise ArchiveDictionaryError(f"共有辞書がありません: {ZDICT_PATH}")
+        _zdict = ZDICT_PATH.read_bytes()
+        _zdict_id = hashlib.sha256(_zdict).hexdigest()[:8]
+    return _zdict
+
+
+def zdict_id() -> str:
+    _get_zdict()
+    return _zdict_id
+
+
+def _compress(raw: bytes) -> bytes:
+    c = zlib.compressobj(level=9, zdict=_get_zdict())
+    return c.compress(raw) + c.flush()
+
+
+def _decompress(blob: bytes, blob_zdict_id: str) -> bytes:
+    if blob_zdict_id != zdict_id():
+        raise ArchiveDictionaryError(
+            f"辞書 {blob_zdict_id} で圧縮された物語は、現在の辞書 {zdict_id()} では展開できません"
+        )
+    d = zlib.decompressobj(zdict=_get_zdict())
+    return d.decompress(blob) + d.flush()
+
+
+def _connect() -> sqlite3.Connection:
+    """共有の接続を返す。_lock の中で呼ぶ。"""
+    global _conn
+    if _conn is None:
+        os.makedirs(DB_PATH.parent, exist_ok=True)
+        conn = sqlite3.connect(str(DB_PATH), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        _conn = conn
+    return _conn
+
+
+def close() -> None:
+    """接続を閉じる（テスト・ベンチマークで保存先を切り替えるとき用）。"""
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+def archive_story(story: List[str], mood: str, works: List[str]) -> str:
+    """
+    完成した物語を保存してハッシュ名を返す。
+    同じ本文の物語がすでにあれば何もしない。
+    """
+    digest = story_hash(story)
+    raw = json.dumps({"story": story}, ensure_ascii=False).encode("utf-8")
+    body = _compress(raw)
+    works = sorted(set(works))
+    with _lock:
+        conn = _connect()
+        with conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO stories (id, mood, works, zdict_id, body) VALUES (?, ?, ?, ?, ?)",
+                (digest, mood, json.dumps(works, ensure_ascii=False), zdict_id(), body),
+            )
+            if cur.rowcount:
+                conn.executemany(
+                    "INSERT INTO story_works (work, seq, mood) VALUES (?, ?, ?)",
+                    [(work, cur.lastrowid, mood) for work in works],
+                )
+                keys = [("", ""), (mood, "")]
+                keys += [k for work in works for k in (("", work), (mood, work))]
+                conn.executemany(
+                    "INSERT INTO story_counts (mood, work, n) VALUES (?, ?, 1)"
+                    " ON CONFLICT (mood, work) DO UPDATE SET n = n + 1",
+                    keys,
+                )
+    return digest
+
+
+def load_archived_story(digest: str) -> Optional[Dict]:
+    """
+    ハッシュ名から物語を読み込む。旧形式（無圧縮の .json）にも対応する。
+    辞書が違えば ArchiveDictionaryError を送出する。
+    """
+    if not is_valid_story_id(digest):
+        return None
+
+    with _lock:
+        row = _connect().execute(
+            "SELECT body, zdict_id FROM stories WHERE id = ?", (digest,)
+        ).fetchone()
+    if row is not None:
+        return json.loads(_decompress(row[0], row[1]).decode("utf-8"))
+
+    legacy = ARCHIVE_DIR / f"{digest}.json"
+    if legacy.exists():
+        with open(legacy, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return None
+
+
+def list_archived_stories(
+    mood: Optional[str] = None,
+    work: Optional[str] = None,
+    offset: int = 0,
+    limit: int = DEFAULT_PAGE_SIZE,
+) -> Dict:
+    """
+    エンディングの感情・作品で絞り込んだ索引を 1 ページ分返す。
+    next_offset が None でなければ、続きはその offset で取得する。
+    """
+    offset = max(offset, 0)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    if work:
+        source = "story_works w JOIN stories s ON s.seq = w.seq"
+        where, params = ["w.work = ?"], [work]
+        if mood:
+            where.append("w.mood = ?")
+            params.append(mood)
+        order = "w.seq"
+    else:
+        source = "stories s"
+        where, params = (["s.mood = ?"], [mood]) if mood else ([], [])
+        order = "s.seq"
+    condition = f"WHERE {' AND '.join(where)}" if where else ""
+
+    with _lock:
+        conn = _connect()
+        count = conn.execute(
+            "SELECT n FROM story_counts WHERE mood = ? AND work = ?", (mood or "", work or "")
+        ).fetchone()
+        total = count[0] if count else 0
+        rows = conn.execute(
+            f"SELECT s.id, s.mood, s.works FROM {source} {condition} ORDER BY {order} LIMIT ? OFFSET ?",
+            params + [limit, offset],
+        ).fetchall()
+
+    page = [{"id": i, "mood": m, "works": json.loads(w)} for i, m, w in rows]
+    next_offset = offset + limit if offset + limit < total else None
+    return {"stories": page, "total": total, "next_offset": next_offset}
+
+
+def archive_stats() -> Dict[str, float]:
+    """保存件数と 1 物語あたりの平均ディスク使用量（割り当てられたブロック単位、バイト）を返す。"""
+    with _lock:
+        row = _connect().execute(
+            "SELECT n FROM story_counts WHERE mood = '' AND work = ''"
+        ).fetchone()
+    count = row[0] if row else 0
+    disk = 0
+    for path in (DB_PATH, DB_PATH.with_name(DB_PATH.name + "-wal")):
+        if path.exists():
+            disk += path.stat().st_blocks * 512
+    return {
+        "count": count,
+        "disk_bytes": disk,
+        "bytes_per_story": disk / count if count else 0.0,
+    }
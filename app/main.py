@@ -2,8 +2,14 @@
 # サーバー起動ファイル、ルーティング定義
 import os
 import json
+import hashlib
+import logging
+import threading
+import time
+import uuid
 import requests
 import random
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from flask import (
     Flask,
     render_template,
@@ -15,7 +21,23 @@ from flask import (
 )
 from dotenv import load_dotenv
 from app.core.mood_chain import QuoteManager
-from .core.llm_connector import generate_options_from_csv
+from app.core.context_cache import ContextCache
+from app.core.local_generator import LocalSceneGenerator
+from app.core.story_archive import (
+    DEFAULT_PAGE_SIZE,
+    ArchiveDictionaryError,
+    archive_story,
+    is_valid_story_id,
+    list_archived_stories,
+    load_archived_story,
+)
+from .core.llm_connector import (
+    generate_options_from_csv,
+    generate_local_options,
+    model_router,
+    options_cache,
+)
+from .core.admission import AdmissionController, Overloaded
 from typing import List, Dict
 
 # .envファイルから環境変数を読み込む（ローカル開発用）
@@ -30,8 +52,14 @@ CORS(app)
 # --- グローバルな設定と初期化 ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "YOUR_FALLBACK_API_KEY")
 QUOTE_MANAGER = QuoteManager()
-GEMINI_MODEL = "gemini-2.5-flash-preview-09-2025"
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
+# モデル名は model_router が呼び出しごとに選ぶ
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+# 文章生成の待ち時間の上限（秒）
+SCENE_TIMEOUT = 10
+# LLM を呼ぶルートの同時実行数・待ち行列の上限
+ADMISSION = AdmissionController()
+# 文章生成の方式: "gemini"（既定）または "local"（オフライン・ネットワーク不要）
+SCENE_BACKEND = os.getenv("SCENE_BACKEND", "gemini")
 
 # 作品ID → アイコンファイル名
 WORK_ICON_MAP = {
@@ -69,6 +97,40 @@ SERINENTIUS_RULE = (
 )
 
 
+# /choose の文章生成ルールのうち、毎回変わらない部分（コンテキストキャッシュに登録する）
+SCENE_RULES = (
+    "あなたは日本近代文学に精通した孤高の語り手です。\n"
+    "現在、『走れメロス』の世界に、他の文豪の作品が『霧』のように干渉している特殊な状況を描いています。\n\n"
+
+    "【執筆の厳格なルール】\n"
+    "1. **メタ情報の禁止**: 『【物語フェーズ】』といった見出しや、ターン数、解説、挨拶は絶対に書かないでください。小説の本文のみを出力してください。\n"
+    "2. **表現の鮮明化**: 『走る』『焦燥』といった言葉の多用を避け、代わりにその作品特有の色彩、音、温度感（例：檸檬の冷たさ、山猫軒の扉の音、先生の静かな声）でメロスの心境を代弁してください。\n"
+    "3. **文体**: 太宰治のような熱量と、他作品の冷徹な静謐さが混ざり合った、格調高い文学的文体で執筆してください。高校生が理解できる単語・文章の難易度で執筆してください。\n"
+    "4. **文字数と改行**: 150字から200字程度。縦書きの作文用紙で見栄えを良くするため、**句点（。）の後は必ず一度改行を入れてください。** 文末以外での改行は不要ですが、一文ごとに改行することで、心地よいリズムを刻んでください。\n\n"
+)
+
+CACHED_CONTENTS_URL = "https://generativelanguage.googleapis.com/v1beta/cachedContents"
+
+
+def create_scene_cache(model_name, text, ttl):
+    """text をシステム指示として cachedContents に登録し、キャッシュ名を返す。"""
+    res = requests.post(
+        f"{CACHED_CONTENTS_URL}?key={GEMINI_API_KEY}",
+        json={
+            "model": f"models/{model_name}",
+            "systemInstruction": {"parts": [{"text": text}]},
+            "ttl": f"{ttl}s",
+        },
+        timeout=SCENE_TIMEOUT,
+    )
+    res.raise_for_status()
+    return res.json()["name"]
+
+
+# SCENE_RULES のキャッシュ（モデルごと）
+scene_cache = ContextCache(create_scene_cache)
+
+
 def attach_icons(options):
     """各 option に icon_filename キーを追加するヘルパー。"""
     for opt in options:
@@ -79,6 +141,231 @@ def attach_icons(options):
 
 
 
+def generate_scene(chosen_text, chosen_mood, next_theme, current_work, turn, previous_story,
+                   speculative=False):
+    """
+    選ばれた選択肢から次の場面の文章を LLM で生成する。
+    (文章, usageMetadata) を返す。先読みからは speculative=True で呼ぶ。
+    """
+    phase_instruction = PHASE_INSTRUCTIONS.get(turn, "")
+    serinentius_instruction = ""
+    if turn + 1 >= 3:
+        serinentius_instruction = SERINENTIUS_RULE
+
+    # --- 指示のうち毎回変わる部分（静的なルールは SCENE_RULES） ---
+    scene_context = (
+        "【今回の作品】\n"
+        f"**作品の純度**: 今回の描写では、絶対に『{current_work}』以外の作品の固有名詞やモチーフを出さないでください。（例：注文の多い料理店なら、レモンの話は一切しないこと）\n\n"
+
+        f"【現在の進行状況】\n"
+        f"フェーズ指針: {phase_instruction}\n"
+        f"{serinentius_instruction}\n"
+        f"これまでの文脈: {previous_story}\n"
+    )
+
+    # --- User Prompt （今回の場面指示）---
+    user_prompt = (
+        f"状況：メロスが「{chosen_text}」と叫び、駆け抜ける。\n"
+        f"干渉する世界：『{current_work}』\n"
+        f"メロスの心の色（感情）：{chosen_mood}\n"
+        f"次の展開への予兆：{next_theme}\n\n"
+        f"指示：これらの要素を溶け合わせ、メロスの走りに新たな『一歩』を刻む文章を書いてください。文末（。）ごとに必ず改行を入れ、縦書きの作文用紙として美しいリズムで描写せよ。"
+      )
+
+    def post_to_model(model_name):
+        # 可変部分はキャッシュの有無にかかわらず user ターンで送る（SCENE_RULES だけが system 指示）
+        payload = {
+            "contents": [
+                {"role": "user", "parts": [{"text": scene_context + "\n" + user_prompt}]}
+            ],
+        }
+        # SCENE_RULES を登録済みなら、それを参照して可変部分だけを送る
+        cache_name = scene_cache.get(model_name, "scene", SCENE_RULES)
+        if cache_name:
+            payload["cachedContent"] = cache_name
+        else:
+            payload["systemInstruction"] = {"parts": [{"text": SCENE_RULES}]}
+
+        start = time.monotonic()
+        res = requests.post(
+            f"{GEMINI_API_URL.format(model=model_name)}?key={GEMINI_API_KEY}",
+            json=payload,
+            timeout=SCENE_TIMEOUT
+        )
+        if cache_name and res.status_code in (400, 403, 404):
+            # キャッシュが期限切れ・削除済みなら次回登録し直す
+            scene_cache.invalidate(model_name, "scene")
+        res.raise_for_status()
+
+        data = res.json()
+        usage = data.get("usageMetadata", {})
+        scene_cache.record(
+            cached=bool(cache_name),
+            prompt_tokens=usage.get("promptTokenCount", 0),
+            cached_tokens=usage.get("cachedContentTokenCount", 0),
+            seconds=time.monotonic() - start,
+        )
+        return data
+
+    # 応答時間・エラー率に応じてモデルを選ぶ
+    # （先読みは、プレイヤーを待たせる呼び出しの混み具合には数えない）
+    data = model_router.call("scene", post_to_model, speculative=speculative)
+    scene_text = data["candidates"][0]["content"]["parts"][0]["text"].strip()
+    return scene_text, data.get("usageMetadata", {})
+
+
+# ----------------------------------------------------------------------------------
+#  先読み生成：/game で 3 つの選択肢すべての文章を並行して生成しておき、
+#  /choose では選ばれたものだけを使う
+# ----------------------------------------------------------------------------------
+SPECULATION_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SPECULATION_WORKERS", "6")),
+    thread_name_prefix="speculation",
+)
+# story_id → {"turn": ターン, "created": 開始時刻,
+#              "futures": {(text, mood, work_id): Future}, "slots": {(text, mood, work_id): Slot}}
+_speculations: Dict[str, Dict] = {}
+# /choose に来ないまま（タブを閉じた等）これより古くなった先読みは捨てる（秒）
+SPECULATION_TTL = int(os.getenv("SPECULATION_TTL", "600"))
+# 取り消した Future のコールバックがロック中に同期実行されることがあるので RLock
+_speculation_lock = threading.RLock()
+
+# 余分にかかったトークンと、体感待ち時間の短縮量
+SPECULATION_STATS = {
+    "launched": 0,          # 先読みした文章の数
+    "used": 0,              # 実際に使われた数
+    "discarded": 0,         # 選ばれずに捨てた数
+    "expired": 0,           # /choose に来ないまま期限切れで捨てた数
+    "failed": 0,            # 選ばれたが失敗・時間切れで使えなかった数（直接生成し直す）
+    "used_tokens": 0,       # 使われた先読みのトークン数
+    "wasted_tokens": 0,     # 捨てた先読みのトークン数
+    "saved_seconds": 0.0,   # 先読みで短縮できた待ち時間の合計
+}
+
+
+def _timed_generate_scene(*args):
+    start = time.monotonic()
+    scene_text, usage = generate_scene(*args, speculative=True)
+    return scene_text, usage, time.monotonic() - start
+
+
+def _count_wasted(future):
+    """破棄した先読みが最後まで走った場合、そのトークンを無駄として数える。"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    _, usage, _ = future.result()
+    with _speculation_lock:
+        SPECULATION_STATS["wasted_tokens"] += usage.get("totalTokenCount", 0)
+
+
+def _discard(entry):
+    """
+    先読みを取り消す。走り出しているものも結果を待たずに先読みの枠を返すが、
+    終わるまでは切り離し中（ADMISSION.snapshot() の speculative_detached）として数える。
+    """
+    for key, future in entry["futures"].items():
+        SPECULATION_STATS["discarded"] += 1
+        # 待ち行列にあれば取り消した時点で（完了時のコールバックで）枠が返る
+        if not future.cancel():
+            entry["slots"][key].detach()
+            future.add_done_callback(_count_wasted)
+
+
+def _expire_speculations(now=None):
+    """SPECULATION_TTL より古い先読みを捨てる。_speculation_lock の中で呼ぶ。"""
+    cutoff = (now or time.monotonic()) - SPECULATION_TTL
+    expired = [sid for sid, entry in _speculations.items() if entry["created"] < cutoff]
+    for sid in expired:
+        entry = _speculations.pop(sid)
+        SPECULATION_STATS["expired"] += len(entry["futures"])
+        _discard(entry)
+    return len(expired)
+
+
+def start_speculation(story_id, turn, options, previous_story):
+    """表示した選択肢それぞれについて、/choose と同じ引数で文章生成を始める。"""
+    if not story_id:
+        return
+    with _speculation_lock:
+        _expire_speculations()
+        # 再読み込みなどで前の先読みが残っていれば、先に捨てて枠を空ける
+        old = _speculations.pop(story_id, None)
+        if old:
+            _discard(old)
+
+        futures, slots = {}, {}
+        for opt in options:
+            # game.html のフォームと同じ値（next_theme には next_mood が入る）
+            key = (opt.get("text", ""), opt.get("next_mood") or "neutral", opt.get("work_id", ""))
+            if key in futures:
+                continue
+            try:
+                # 先読みは無くても困らないので、空きが無ければ待たずに見送る
+                slot = ADMISSION.admit_speculative(story_id)
+            except Overloaded:
+                break
+            future = SPECULATION_EXECUTOR.submit(
+                _timed_generate_scene, key[0], key[1], key[1], key[2], turn, previous_story
+            )
+            # 取り消し・完了のどちらでも枠を返す
+            future.add_done_callback(lambda _f, slot=slot: slot.release())
+            futures[key], slots[key] = future, slot
+
+        _speculations[story_id] = {
+            "turn": turn, "created": time.monotonic(), "futures": futures, "slots": slots,
+        }
+        SPECULATION_STATS["launched"] += len(futures)
+
+
+def take_speculation(story_id, turn, key):
+    """選ばれた選択肢の先読みを取り出し、それ以外は取り消す。無ければ None。"""
+    with _speculation_lock:
+        entry = _speculations.pop(story_id, None) if story_id else None
+        if entry is None:
+            return None
+        chosen = None
+        if entry["turn"] == turn and key in entry["futures"]:
+            # 選ばれたものの枠は、生成が終わったときに返る
+            chosen = entry["futures"].pop(key)
+            entry["slots"].pop(key)
+        _discard(entry)
+    return chosen
+
+
+def wait_for_speculation(future):
+    """
+    選ばれた先読みの結果を待って文章を返す。失敗・時間切れなら None（呼び出し側で直接生成する）。
+    時間切れのものが後から終わった場合、そのトークンは無駄として数える。
+    """
+    wait_start = time.monotonic()
+    try:
+        scene_text, usage, elapsed = future.result(timeout=SCENE_TIMEOUT)
+    except FutureTimeoutError:
+        print("Speculation Timeout: generating directly")
+        future.add_done_callback(_count_wasted)
+    except Exception as e:
+        print(f"Speculation Error: {e}")
+    else:
+        record_speculation_hit(usage, elapsed, time.monotonic() - wait_start)
+        return scene_text
+    with _speculation_lock:
+        SPECULATION_STATS["failed"] += 1
+    return None
+
+
+def record_speculation_hit(usage, elapsed, waited):
+    """使われた先読みについて、トークン数と短縮できた待ち時間を記録する。"""
+    with _speculation_lock:
+        SPECULATION_STATS["used"] += 1
+        SPECULATION_STATS["used_tokens"] += usage.get("totalTokenCount", 0)
+        SPECULATION_STATS["saved_seconds"] += max(elapsed - waited, 0.0)
+        stats = dict(SPECULATION_STATS)
+    print(
+        f"Speculation: saved {max(elapsed - waited, 0.0):.2f}s "
+        f"(used_tokens={stats['used_tokens']}, wasted_tokens={stats['wasted_tokens']})"
+    )
+
+
 #--------------------------------------------------------------
 #  index.html → play.html(1ターン目) → game.html(1ターン目) →・・・
 #    → play.html(3ターン目) → game.html(3ターン目) → ending.html
@@ -150,7 +437,10 @@ def start_game():
     session["turn"] = 1
     session["history"] = []
     session["current_mood"] = "neutral"
-    save_story({"story": []})
+    session["works"] = []
+    # プレイヤーごとに物語ファイルを分ける（古いものはここで片付ける）
+    cleanup_session_stories()
+    save_story({"story": []}, current_story_id())
     return redirect(url_for("play"))
 
 # play.html（メロスが走る画面）
@@ -161,7 +451,9 @@ def play():
     mood = session.get("current_mood", "neutral")  # デフォルトは neutral
     
     # 2. テンプレートに mood を渡す（これによりHTML側で {{ mood }} が使えます）
-    return render_template("play.html", turn=turn, mood=mood)
+    return render_template(
+        "play.html", turn=turn, mood=mood, story_id=current_story_id()
+    )
 
 
 # 選択肢が出る画面（game.html） ←【ファイル名わかりにくいから変えた方がいいかも】
@@ -171,8 +463,16 @@ def game():
     current_mood = session.get("current_mood", "neutral")
     current_mood_label = EMOTION_LABELS.get(current_mood, current_mood)
 
-    # 現在の感情に応じた選択肢を生成
-    options = generate_options_from_csv(current_mood)
+    # 現在の感情に応じた選択肢を生成（オフライン・混雑時・障害時は LLM を使わずに選ぶ）
+    if SCENE_BACKEND == "local":
+        options = generate_local_options(current_mood)
+    else:
+        try:
+            with ADMISSION.admit(current_story_id()):
+                options = generate_options_from_csv(current_mood)
+        except Exception as e:
+            print(f"Options Generation Error: {e}")
+            options = generate_local_options(current_mood)
     
     # 【重要】optionsの中身が辞書(dict)であることを確認し、アイコンを付与
     options = attach_icons(options)
@@ -182,6 +482,12 @@ def game():
         print(f"[{i}]", opt)
     print("=================")
 
+    # プレイヤーが選択肢を読んでいる間に、3 つとも文章生成を始めておく
+    if SCENE_BACKEND != "local":
+        story_id = current_story_id()
+        previous_story = "\n".join(load_story(story_id).get("story", []))
+        start_speculation(story_id, turn, options, previous_story)
+
     return render_template(
         "game.html",
         options=options,  # 辞書のリストとして渡す
@@ -215,7 +521,7 @@ def choose():
 """
 @app.post("/api/reset_story")
 def reset_story():
-    save_story({"story": []})
+    save_story({"story": []}, current_story_id())
     return jsonify({"ok": True})
 
 @app.route("/choose", methods=["POST"])
@@ -231,76 +537,53 @@ def choose():
     history.append(chosen_mood)
     session["history"] = history
     session["current_mood"] = chosen_mood
+    works = session.get("works", [])
+    works.append(current_work)
+    session["works"] = works
 
     turn = session.get("turn", 1)
     session["turn"] = turn + 1
     session.modified = True
 
     # --- 3. LLM による文章生成 ---
+    story_id = current_story_id()
     try:
-        story_data = load_story()
+        story_data = load_story(story_id)
         previous_story = "\n".join(story_data.get("story", []))
 
-        phase_instruction = PHASE_INSTRUCTIONS.get(turn, "")
-        serinentius_instruction = ""
-        if session["turn"] >= 3:
-            serinentius_instruction = SERINENTIUS_RULE
-        
-        # --- system instruction（物語ルール） ---
-        system_instruction = (
-            "あなたは日本近代文学に精通した孤高の語り手です。\n"
-            "現在、『走れメロス』の世界に、他の文豪の作品が『霧』のように干渉している特殊な状況を描いています。\n\n"
-            
-            "【執筆の厳格なルール】\n"
-            f"1. **作品の純度**: 今回の描写では、絶対に『{current_work}』以外の作品の固有名詞やモチーフを出さないでください。（例：注文の多い料理店なら、レモンの話は一切しないこと）\n"
-            "2. **メタ情報の禁止**: 『【物語フェーズ】』といった見出しや、ターン数、解説、挨拶は絶対に書かないでください。小説の本文のみを出力してください。\n"
-            "3. **表現の鮮明化**: 『走る』『焦燥』といった言葉の多用を避け、代わりにその作品特有の色彩、音、温度感（例：檸檬の冷たさ、山猫軒の扉の音、先生の静かな声）でメロスの心境を代弁してください。\n"
-            "4. **文体**: 太宰治のような熱量と、他作品の冷徹な静謐さが混ざり合った、格調高い文学的文体で執筆してください。高校生が理解できる単語・文章の難易度で執筆してください。\n"
-            "5. **文字数と改行**: 150字から200字程度。縦書きの作文用紙で見栄えを良くするため、**句点（。）の後は必ず一度改行を入れてください。** 文末以外での改行は不要ですが、一文ごとに改行することで、心地よいリズムを刻んでください。\n\n"
-            
-            f"【現在の進行状況】\n"
-            f"フェーズ指針: {phase_instruction}\n"
-            f"{serinentius_instruction}\n"
-            f"これまでの文脈: {previous_story}\n"
-        )
-
-        # --- User Prompt （今回の場面指示）---
-        user_prompt = (
-            f"状況：メロスが「{chosen_text}」と叫び、駆け抜ける。\n"
-            f"干渉する世界：『{current_work}』\n"
-            f"メロスの心の色（感情）：{chosen_mood}\n"
-            f"次の展開への予兆：{next_theme}\n\n"
-            f"指示：これらの要素を溶け合わせ、メロスの走りに新たな『一歩』を刻む文章を書いてください。文末（。）ごとに必ず改行を入れ、縦書きの作文用紙として美しいリズムで描写せよ。"
-          )
-
-        payload = {
-            "contents": [
-                {"parts": [{"text": user_prompt}]}
-            ],
-            "systemInstruction": {
-                "parts": [{"text": system_instruction}]
-            }
-        }
+        # /game で先読み生成していれば、その結果を使う（残りの 2 つは破棄）
+        future = take_speculation(story_id, turn, (chosen_text, chosen_mood, current_work))
+        scene_text = None
+        if SCENE_BACKEND == "local":
+            scene_text = LOCAL_GENERATOR.generate(chosen_text, work=current_work)
+        elif future is not None and future.cancel():
+            # まだ待ち行列にあって始まっていない（先読みが詰まっている）なら、待たずにここで生成する
+            pass
+        elif future is not None:
+            # 先読みが失敗・時間切れなら None が返り、下で直接生成し直す
+            scene_text = wait_for_speculation(future)
+
+        if scene_text is None:
+            # 混雑していれば Overloaded で下のフォールバックに回る
+            with ADMISSION.admit(story_id):
+                scene_text, usage = generate_scene(
+                    chosen_text, chosen_mood, next_theme, current_work, turn, previous_story
+                )
 
-        res = requests.post(
-            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-            json=payload,
-            timeout=10
-        )
-        res.raise_for_status()
-
-        scene_text = res.json()["candidates"][0]["content"]["parts"][0]["text"].strip()
         story_data["story"].append(scene_text)
-        save_story(story_data)
+        save_story(story_data, story_id)
 
     except Exception as e:
         print(f"LLM Generation Error: {e}")
-        # フォールバック（物語が止まらないため）
-        story_data = load_story()
-        story_data["story"].append(
-            f"メロスは{next_theme}の気配を胸に抱いたまま、歩みを止めなかった。"
-        )
-        save_story(story_data)
+        # フォールバック（物語が止まらないため、オフラインの生成に切り替える）
+        try:
+            scene_text = LOCAL_GENERATOR.generate(chosen_text, work=current_work)
+        except Exception as e:
+            print(f"Local Generation Error: {e}")
+            scene_text = f"メロスは{next_theme}の気配を胸に抱いたまま、歩みを止めなかった。"
+        story_data = load_story(story_id)
+        story_data["story"].append(scene_text)
+        save_story(story_data, story_id)
 
     # --- 4. 進行判定 ---
     if session["turn"] > 4:
@@ -325,7 +608,7 @@ def ending():
     history_labels = [EMOTION_LABELS.get(m, m) for m in full_history_raw]
 
     # 3. これまで生成された文章をすべて読み込む
-    story_data = load_story()
+    story_data = load_story(current_story_id())
     generated_story = story_data.get("story", [])
 
     # 初期文章（固定）
@@ -336,6 +619,13 @@ def ending():
 
     print(full_story)
 
+    # 完成した物語をアーカイブに残す（同じ物語は重複保存しない）
+    if generated_story:
+        try:
+            archive_story(generated_story, final_mood, session.get("works", []))
+        except Exception as e:
+            print(f"Archive Error: {e}")
+
     return render_template(
         "ending.html",
         final_label=final_label,
@@ -379,26 +669,193 @@ def get_next_choices():
 # APIエンドポイント 2: LLMによる場面の橋渡しテキスト生成
 # ----------------------------------------------------------------------------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-STORY_PATH = os.path.join(BASE_DIR, "static", "data", "story.json")
+# プレイヤーごとの物語（static の外に置き、他人の物語が配信されないようにする）
+SESSION_STORY_DIR = os.path.join(BASE_DIR, "..", "data", "sessions")
+# これより古いプレイヤーの物語は /start のときに削除する（秒）
+SESSION_STORY_TTL = int(os.getenv("SESSION_STORY_TTL", str(24 * 60 * 60)))
 
-def load_story():
-    if not os.path.exists(STORY_PATH):
+def current_story_id():
+    """
+    セッションの story_id を返す。
+    /start を通らずに来た場合もここで作り、他のプレイヤーの物語と混ざらないようにする。
+    """
+    story_id = session.get("story_id")
+    if not is_valid_story_id(story_id):
+        story_id = uuid.uuid4().hex[:16]
+        session["story_id"] = story_id
+    return story_id
+
+def _story_path(story_id):
+    if not is_valid_story_id(story_id):
+        raise ValueError(f"story_id が正しくありません: {story_id!r}")
+    return os.path.join(SESSION_STORY_DIR, f"{story_id}.json")
+
+def cleanup_session_stories(now=None):
+    """SESSION_STORY_TTL より前に更新されたプレイヤーの物語を削除する。"""
+    if not os.path.isdir(SESSION_STORY_DIR):
+        return 0
+    cutoff = (now or time.time()) - SESSION_STORY_TTL
+    removed = 0
+    for entry in os.scandir(SESSION_STORY_DIR):
+        try:
+            if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            continue  # 他のリクエストが先に消した場合など
+    return removed
+
+def load_story(story_id):
+    path = _story_path(story_id)
+    if not os.path.exists(path):
         return {"story": []}
-    with open(STORY_PATH, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def save_story(story_data):
-    os.makedirs(os.path.dirname(STORY_PATH), exist_ok=True)
-    with open(STORY_PATH, "w", encoding="utf-8") as f:
+def save_story(story_data, story_id):
+    path = _story_path(story_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
         json.dump(story_data, f, ensure_ascii=False, indent=2)
 
 
+@app.route("/api/story")
+def get_story():
+    """
+    since=<index> 以降に生成された段落だけを返す。
+    ETag が一致すれば 304 を返すので、クライアントは差分だけを受け取る。
+    """
+    story_id = current_story_id()
+    story = load_story(story_id).get("story", [])
+    since = request.args.get("since", 0, type=int) or 0
+
+    # 手元の段落数が現在の物語より多い = 新しいゲームが始まったので最初から送る
+    reset = since > len(story) or since < 0
+    if reset:
+        since = 0
+
+    body = {"since": since, "total": len(story), "reset": reset, "story": story[since:]}
+    payload = json.dumps(body, ensure_ascii=False)
+    etag = hashlib.sha1(
+        f"{story_id}:{payload}".encode("utf-8")
+    ).hexdigest()
+
+    response = app.response_class(payload, mimetype="application/json")
+    response.set_etag(etag)
+    # 本人のセッション専用・毎回 ETag で再検証
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
+
+
+# ----------------------------------------------------------------------------------
+# APIエンドポイント: 流量制御・先読み生成・モデル振り分け・コンテキストキャッシュの状況
+# ----------------------------------------------------------------------------------
+@app.route("/api/metrics")
+def get_metrics():
+    with _speculation_lock:
+        speculation = dict(SPECULATION_STATS)
+    return jsonify({
+        "speculation": speculation,
+        "admission": ADMISSION.snapshot(),
+        "model_router": model_router.snapshot(),
+        "context_cache": {
+            "options": options_cache.snapshot(),
+            "scene": scene_cache.snapshot(),
+        },
+    })
+
+
+# ----------------------------------------------------------------------------------
+# APIエンドポイント: 完成した物語のアーカイブ
+# ----------------------------------------------------------------------------------
+@app.route("/api/archive")
+def get_archive_list():
+    """
+    エンディングの感情（mood）・作品（work）で絞り込んだアーカイブ一覧を返す。
+    offset・limit でページ分けする（続きは next_offset で取得）。
+    """
+    result = list_archived_stories(
+        mood=request.args.get("mood"),
+        work=request.args.get("work"),
+        offset=request.args.get("offset", 0, type=int),
+        limit=request.args.get("limit", DEFAULT_PAGE_SIZE, type=int),
+    )
+    return jsonify(result)
+
+
+@app.route("/api/archive/<story_id>")
+def get_archived_story(story_id):
+    if not is_valid_story_id(story_id):
+        return jsonify({"error": "物語の ID が正しくありません。"}), 400
+    try:
+        story_data = load_archived_story(story_id)
+    except ArchiveDictionaryError as e:
+        print(f"Archive Error: {e}")
+        return jsonify({"error": "この物語は現在の辞書では読み込めません。"}), 500
+    if story_data is None:
+        return jsonify({"error": "物語が見つかりませんでした。"}), 404
+    return jsonify(story_data)
 
 
 # ----------------------------------------------------------------------------------
 # ★ 新規追加部分：あらすじ機能
 # ----------------------------------------------------------------------------------
 
+# ★ ここに各作品のあらすじ文章を自由に記述してください
+SYNOPSIS_DATA = {
+    "hashire": {
+        "title": "走れメロス", 
+        "text": """
+            羊飼いのメロスは、暴君と噂される王に会うため都を訪れる。<br>
+            王が人を疑い、無実の人々を処刑していることを知ったメロスは怒りをぶつけるが、逆に捕らえられ死刑を宣告される。<br><br>
+            メロスは妹の結婚式を行うため三日間の猶予を願い出て、代わりに親友<b>セリヌンティウス</b>を人質として残す。<br><br>
+            道中、川の氾濫や山賊などの困難に遭い、心が折れそうになりながらも、友への信頼と約束を守るため必死に走り続ける。<br><br>
+            期限ぎりぎりで都に戻ったメロスの姿に王は心を打たれ、人を信じる気持ちを取り戻す。<br><br>
+            <b>友情と信頼の尊さ</b>を描いた、太宰治の不朽の名作。
+        """
+    },
+    "lemon": {
+        "title": "檸檬", 
+        "text": """
+            心身の不調に悩む「私」は、重苦しい気分を抱えながら京都の町をさまよい歩く。<br>
+            かつて心を躍らせた丸善の棚や音楽さえも、今の「私」にはただ不潔で退屈なものにしか見えない。<br><br>
+            ある時、気晴らしに立ち寄った果物屋で、鮮やかな一個の<b>檸檬</b>を買い求める。<br>
+            その冷たさ、強い色、そして爽やかな香りに、「私」は一時的な解放感を覚える。<br><br>
+            その後、再び訪れた丸善の店内で、「私」は美術書の山の上にそっと檸檬を置く。<br>
+            それを<b>黄金色の爆弾</b>に見立て、店を立ち去る「私」。<br><br>
+            憂鬱な日常から一瞬だけ逃れるひそかな快感を描いた、梶井基次郎の代表作。
+        """
+    },
+    "kokoro": {
+        "title": "こころ", 
+        "text": """
+            鎌倉の海岸で「私」が出会ったのは、どこか世間を避けて生きる<b>「先生」</b>だった。<br>
+            次第に親交を深めていくが、先生は時折、人付き合いを拒むような暗い影を見せる。<br><br>
+            やがて、先生から「私」のもとに届いた一通の分厚い<b>遺書</b>。<br>
+            そこには、若き日の先生が親友「K」と同じ女性を愛し、卑怯な裏切りによって<b>Kを自死へ追いやってしまった</b>という凄惨な過去が綴られていた。<br><br>
+            長年、消えない罪悪感を抱え続けてきた先生は、明治の時代の終焉とともに、自ら命を絶つ道を選ぶ。<br><br>
+            人間のエゴイズムと救いがたい孤独を深く掘り下げた、夏目漱石の最高傑作。
+        """
+    },
+    "chumon": {
+        "title": "注文の多い料理店", 
+        "text": """
+            山奥へ狩りにやってきた二人の若い紳士は、道に迷い、お腹を空かせていた。<br>
+            そこへ突如として現れた、立派な西洋料理店<b>「山猫軒」</b>。<br><br>
+            扉を開けるたびに「髪をとかしてください」「体に塩を塗り込んでください」といった奇妙な<b>『注文』</b>が次々に現れる。<br>
+            二人はそれを「客へのサービス」だと都合よく解釈し、喜んで従っていくが……。<br><br>
+            実はその店は、人間を食べるために山猫たちが仕掛けた恐ろしい罠だった。<br>
+            あわや料理されそうになった瞬間、連れていた猟犬たちが飛び込み、間一髪で難を逃れる。<br><br>
+            人間の傲慢さを皮肉り、自然の恐ろしさを幻想的に描いた、宮沢賢治の不朽の童話。
+        """
+    }
+}
+
+
+# オフライン用の文章生成（作品ごとに、その作品の引用データと上のあらすじで学習する）
+LOCAL_GENERATOR = LocalSceneGenerator({work_id: [v["text"]] for work_id, v in SYNOPSIS_DATA.items()})
+
 # あらすじ選択画面（4つのタイトルを表示）
 @app.route("/synopsis")
 def synopsis():
@@ -415,57 +872,7 @@ def synopsis():
 @app.route("/synopsis/<work_id>")
 def synopsis_detail(work_id):
     bg_text = get_literary_background()
-    # ★ ここに各作品のあらすじ文章を自由に記述してください
-    synopsis_data = {
-        "hashire": {
-            "title": "走れメロス", 
-            "text": """
-                羊飼いのメロスは、暴君と噂される王に会うため都を訪れる。<br>
-                王が人を疑い、無実の人々を処刑していることを知ったメロスは怒りをぶつけるが、逆に捕らえられ死刑を宣告される。<br><br>
-                メロスは妹の結婚式を行うため三日間の猶予を願い出て、代わりに親友<b>セリヌンティウス</b>を人質として残す。<br><br>
-                道中、川の氾濫や山賊などの困難に遭い、心が折れそうになりながらも、友への信頼と約束を守るため必死に走り続ける。<br><br>
-                期限ぎりぎりで都に戻ったメロスの姿に王は心を打たれ、人を信じる気持ちを取り戻す。<br><br>
-                <b>友情と信頼の尊さ</b>を描いた、太宰治の不朽の名作。
-            """
-        },
-        "lemon": {
-            "title": "檸檬", 
-            "text": """
-                心身の不調に悩む「私」は、重苦しい気分を抱えながら京都の町をさまよい歩く。<br>
-                かつて心を躍らせた丸善の棚や音楽さえも、今の「私」にはただ不潔で退屈なものにしか見えない。<br><br>
-                ある時、気晴らしに立ち寄った果物屋で、鮮やかな一個の<b>檸檬</b>を買い求める。<br>
-                その冷たさ、強い色、そして爽やかな香りに、「私」は一時的な解放感を覚える。<br><br>
-                その後、再び訪れた丸善の店内で、「私」は美術書の山の上にそっと檸檬を置く。<br>
-                それを<b>黄金色の爆弾</b>に見立て、店を立ち去る「私」。<br><br>
-                憂鬱な日常から一瞬だけ逃れるひそかな快感を描いた、梶井基次郎の代表作。
-            """
-        },
-        "kokoro": {
-            "title": "こころ", 
-            "text": """
-                鎌倉の海岸で「私」が出会ったのは、どこか世間を避けて生きる<b>「先生」</b>だった。<br>
-                次第に親交を深めていくが、先生は時折、人付き合いを拒むような暗い影を見せる。<br><br>
-                やがて、先生から「私」のもとに届いた一通の分厚い<b>遺書</b>。<br>
-                そこには、若き日の先生が親友「K」と同じ女性を愛し、卑怯な裏切りによって<b>Kを自死へ追いやってしまった</b>という凄惨な過去が綴られていた。<br><br>
-                長年、消えない罪悪感を抱え続けてきた先生は、明治の時代の終焉とともに、自ら命を絶つ道を選ぶ。<br><br>
-                人間のエゴイズムと救いがたい孤独を深く掘り下げた、夏目漱石の最高傑作。
-            """
-        },
-        "chumon": {
-            "title": "注文の多い料理店", 
-            "text": """
-                山奥へ狩りにやってきた二人の若い紳士は、道に迷い、お腹を空かせていた。<br>
-                そこへ突如として現れた、立派な西洋料理店<b>「山猫軒」</b>。<br><br>
-                扉を開けるたびに「髪をとかしてください」「体に塩を塗り込んでください」といった奇妙な<b>『注文』</b>が次々に現れる。<br>
-                二人はそれを「客へのサービス」だと都合よく解釈し、喜んで従っていくが……。<br><br>
-                実はその店は、人間を食べるために山猫たちが仕掛けた恐ろしい罠だった。<br>
-                あわや料理されそうになった瞬間、連れていた猟犬たちが飛び込み、間一髪で難を逃れる。<br><br>
-                人間の傲慢さを皮肉り、自然の恐ろしさを幻想的に描いた、宮沢賢治の不朽の童話。
-            """
-        }
-    }
-    
-    content = synopsis_data.get(work_id, {"title": "不明", "text": "内容が見つかりませんでした。"})
+    content = SYNOPSIS_DATA.get(work_id, {"title": "不明", "text": "内容が見つかりませんでした。"})
     icon = WORK_ICON_MAP.get(work_id)
     return render_template("synopsis_detail.html", content=content, background_text=bg_text,icon=icon)
 
@@ -480,5 +887,6 @@ def operate():
 
 # サーバーの起動
 if __name__ == '__main__':
-    # 開発サーバー起動
+    # 開発サーバー起動（モデル振り分けのログも表示する）
+    logging.basicConfig(level=logging.INFO)
     app.run(debug=True, host='0.0.0.0', port=5000)
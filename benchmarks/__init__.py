@@ -0,0 +1 @@
+# app.core のマイクロベンチマーク
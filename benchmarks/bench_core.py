@@ -0,0 +1,327 @@
+# app.core の主要処理のマイクロベンチマーク
+# 実行コード：python -m benchmarks.bench_core
+#   --sizes 40,1000        引用データの件数（既定は 40 → 100 万件）
+#   --archive-max 1000000 アーカイブも 100 万件まで測る（数分かかる）
+#   --update-baseline      今回の結果を baselines.json に保存する
+#   --threshold 1.0        基準値の 2 倍より遅くなった処理があれば失敗（終了コード 1）
+#                          静かな専用マシンなら 0.25 程度まで下げられる
+#   --retries 2            遅くなった処理があれば、この回数まで測り直して速い方を使う
+# baselines.json が無いときは比較できないので失敗する（終了コード 2）。
+# 基準値の無い項目（新しく足した処理・件数）は警告だけ出す。
+# 基準値は測ったマシンでしか意味が無いので、別のマシンでは --update-baseline で取り直す。
+import argparse
+import csv
+import gc
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Tuple
+
+# llm_connector は import 時に API キーを要求する（ベンチマークでは通信しない）
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+from app import main as app_main
+from app.core import data_manager, llm_connector, mood_chain, story_archive
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baselines.json"
+DEFAULT_SIZES = [40, 1_000, 10_000, 100_000, 1_000_000]
+# 共有マシン（1 vCPU）では、変更が無くても測り直し後に 1.6 倍程度まで揺れる。
+# それを超える悪化（計算量の変化など）だけを検出する
+DEFAULT_THRESHOLD = 1.0
+# 一時的に遅くなることがあるので、失敗とする前に測り直す
+DEFAULT_RETRIES = 2
+# 比べずに表示だけする項目（時間ではないもの・ディスクの状態に大きく左右されるもの）
+REPORT_ONLY = ("archive_bytes_per_story", "archive_open_peak_bytes", "archive_store")
+# アーカイブは 1 件 1 ファイルなので、既定では件数を抑える
+# 100 万件で測るとき: python -m benchmarks.bench_core --sizes 1000000 --archive-max 1000000
+ARCHIVE_MAX_SIZE = 10_000
+
+WORKS = [
+    ("hashire", "走れメロス", "太宰治"),
+    ("lemon", "檸檬", "梶井基次郎"),
+    ("kokoro", "こころ", "夏目漱石"),
+    ("chumon", "注文の多い料理店", "宮沢賢治"),
+]
+MOODS = ["hopeful", "angry", "melancholic", "anxious", "calm"]
+THEMES = ["友情", "希望", "不安", "孤独", "芸術"]
+FIELDS = [
+    "quote_id", "work_id", "work_title", "author", "text", "speaker",
+    "theme_tags", "mood", "source_citation", "rights_note", "allow_use",
+]
+SAMPLE_TEXTS = [
+    "メロスは激怒した。",
+    "信頼されることは幸福である。",
+    "えたいの知れない不吉な塊が私の心を始終圧えつけていた。",
+    "私はその人を常に先生と呼んでいた。",
+    "どうか帽子と外套と靴をおとり下さい。",
+]
+# load_story / save_story は 16 桁の story_id しか受け付けない
+BENCH_STORY_ID = "0123456789abcdef"
+SAMPLE_SCENE = "メロスは走った。\n友との約束を胸に、夕陽の中を駆け抜けた。\n" * 4
+
+
+def write_quotes_csv(path: Path, size: int) -> None:
+    """quotes.csv と同じ列を持つ合成データを書き出す。"""
+    rng = random.Random(size)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        for i in range(size):
+            work_id, title, author = WORKS[i % len(WORKS)]
+            writer.writerow([
+                i + 1, work_id, title, author,
+                f"{rng.choice(SAMPLE_TEXTS)}（{i}）", "語り手",
+                THEMES[i % len(THEMES)], MOODS[i % len(MOODS)],
+                "青空文庫", "パブリックドメイン", "True",
+            ])
+
+
+def measure(fn: Callable[[], object], repeat: int = 7, min_time: float = 0.05) -> float:
+    """
+    fn 1 回あたりの実行時間（秒）を返す。
+    timeit の推奨どおり、繰り返しのうち最小値を使う（他のプロセスの影響を受けにくい）。
+    """
+    # timeit と同じく、計測中は GC を止める（前の計測で作った大きなデータの回収が混ざらないように）
+    gc.collect()
+    gc.disable()
+    try:
+        return _measure(fn, repeat, min_time)
+    finally:
+        gc.enable()
+
+
+def _measure(fn: Callable[[], object], repeat: int, min_time: float) -> float:
+    fn()  # ウォームアップ
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops *= 10
+
+    results = [elapsed / loops]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        results.append((time.perf_counter() - start) / loops)
+    return min(results)
+
+
+def fake_response(text: str) -> SimpleNamespace:
+    """text 属性が空で candidates から組み立てる経路を通る Gemini 応答。"""
+    part = SimpleNamespace(text=text)
+    cand = SimpleNamespace(
+        finish_reason="STOP", content=SimpleNamespace(parts=[part])
+    )
+    return SimpleNamespace(text=None, candidates=[cand])
+
+
+def bench_corpus(size: int, workdir: Path) -> Dict[str, float]:
+    """引用データの件数に依存する処理。"""
+    csv_path = workdir / f"quotes_{size}.csv"
+    write_quotes_csv(csv_path, size)
+
+    data_manager.QUOTES_CSV = csv_path
+    mood_chain.CSV_FILE_PATH = str(csv_path)
+
+    def load():
+        data_manager.load_quotes.cache_clear()
+        return data_manager.load_quotes()
+
+    results = {"load_quotes": measure(load, repeat=3, min_time=0)}
+
+    def precompute():
+        llm_connector._compact_quotes.cache_clear()
+        return llm_connector._compact_quotes()
+
+    results["compact_quotes"] = measure(precompute, repeat=3, min_time=0)
+    results["select_quotes"] = measure(lambda: llm_connector._select_quotes("hopeful"))
+
+    quote_lines = llm_connector._select_quotes("hopeful")
+    results["build_contents"] = measure(
+        lambda: llm_connector._build_contents("hopeful", quote_lines)
+    )
+
+    manager = mood_chain.QuoteManager()
+    results["get_next_scene_data"] = measure(
+        lambda: manager.get_next_scene_data("hopeful")
+    )
+    return results
+
+
+def bench_fixed(workdir: Path) -> Dict[str, float]:
+    """件数に依存しない処理。"""
+    options = [
+        {"id": i, "text": t, "next_mood": m, "work_id": w[0]}
+        for i, (t, m, w) in enumerate(zip(SAMPLE_TEXTS, MOODS, WORKS * 2))
+    ]
+    raw = "以下が選択肢です。\n```json\n" + json.dumps(
+        {"options": [{"quote_id": i + 1, "next_mood": m} for i, m in enumerate(MOODS[:3])]}
+    ) + "\n```"
+    parsed = llm_connector._parse_options(raw)
+    rsp = fake_response(raw)
+
+    app_main.SESSION_STORY_DIR = str(workdir / "sessions")
+    story_data = {"story": [SAMPLE_SCENE] * 4}
+    app_main.save_story(story_data, BENCH_STORY_ID)
+
+    return {
+        "extract_text": measure(lambda: llm_connector._extract_text(rsp)),
+        "parse_options": measure(lambda: llm_connector._parse_options(raw)),
+        "expand_options": measure(lambda: llm_connector._expand_options(parsed)),
+        "attach_icons": measure(lambda: app_main.attach_icons([dict(o) for o in options])),
+        "load_story": measure(lambda: app_main.load_story(BENCH_STORY_ID)),
+        "save_story": measure(lambda: app_main.save_story(story_data, BENCH_STORY_ID)),
+    }
+
+
+def bench_archive(size: int, workdir: Path) -> Dict[str, float]:
+    """物語アーカイブの 1 件あたりのディスク使用量・メモリ使用量と検索時間。"""
+    story_archive.close()
+    story_archive.ARCHIVE_DIR = workdir / f"archive_{size}"
+    story_archive.DB_PATH = story_archive.ARCHIVE_DIR / "archive.sqlite3"
+
+    def store(i):
+        story = [f"{SAMPLE_SCENE}（{i}）"] * 4
+        return story_archive.archive_story(story, MOODS[i % len(MOODS)], [WORKS[i % len(WORKS)][0]])
+
+    ids = [store(i) for i in range(size)]
+    rng = random.Random(size)
+    last_page = max(size // len(MOODS) - story_archive.DEFAULT_PAGE_SIZE, 0)
+
+    # 開き直すところから測る（再起動直後の最初の一覧）
+    def reopen():
+        story_archive.close()
+        return story_archive.list_archived_stories()
+
+    # 再起動直後の一覧で確保される Python 側のメモリ（SQLite のページキャッシュは cache_size で上限がある）
+    story_archive.close()
+    tracemalloc.start()
+    story_archive.list_archived_stories(mood="calm", work="hashire", offset=last_page)
+    open_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    raw = json.dumps({"story": [SAMPLE_SCENE] * 4}, ensure_ascii=False).encode("utf-8")
+    results = {
+        "archive_compress": measure(lambda: story_archive._compress(raw)),
+        "archive_open": measure(reopen, repeat=3, min_time=0),
+        "archive_load": measure(lambda: story_archive.load_archived_story(rng.choice(ids))),
+        "archive_list_by_mood": measure(lambda: story_archive.list_archived_stories(mood="calm")),
+        "archive_list_last_page": measure(
+            lambda: story_archive.list_archived_stories(mood="calm", work="hashire", offset=last_page)
+        ),
+        "archive_bytes_per_story": story_archive.archive_stats()["bytes_per_story"],
+        "archive_open_peak_bytes": open_peak,
+    }
+    # 1 件追加する時間（size 件入った状態から。一覧の計測を済ませてから足していく）
+    # 書き込みはディスクの状態に左右されるので比べない。圧縮の速さは archive_compress で比べる
+    # 直前までに書いたデータの書き出しが混ざらないよう、先にディスクへ書き出しておく
+    if hasattr(os, "sync"):
+        os.sync()
+    counter = itertools.count(size)
+    results["archive_store"] = measure(lambda: store(next(counter)))
+    return results
+
+
+def compare(
+    results: Dict[str, float], baselines: Dict[str, float], threshold: float, verbose: bool = True
+) -> Tuple[List[str], List[str]]:
+    """(基準値より遅くなった項目, 基準値の無い項目) を返す。"""
+    regressions, missing = [], []
+    for key, value in sorted(results.items()):
+        base = baselines.get(key)
+        if key.split("@")[0] in REPORT_ONLY:
+            note = f"{value / base:6.2f}x  (参考)" if base else "  (参考)"
+        elif base:
+            ratio = value / base
+            note = f"{ratio:6.2f}x"
+            if ratio > 1 + threshold:
+                regressions.append(key)
+                note += "  << REGRESSION"
+        else:
+            missing.append(key)
+            note = "  (基準値なし)"
+        if verbose:
+            print(f"{key:40s} {value:14.9f} {note}")
+    return regressions, missing
+
+
+def run_all(sizes: List[int], archive_max: int) -> Dict[str, float]:
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        for key, value in bench_fixed(workdir).items():
+            results[key] = value
+        for size in sizes:
+            for key, value in bench_corpus(size, workdir).items():
+                results[f"{key}@{size}"] = value
+            if size <= archive_max:
+                for key, value in bench_archive(size, workdir).items():
+                    results[f"{key}@{size}"] = value
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="app.core マイクロベンチマーク")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES))
+    parser.add_argument("--archive-max", type=int, default=ARCHIVE_MAX_SIZE)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    results = run_all(sizes, args.archive_max)
+
+    baselines = {}
+    if BASELINE_PATH.exists():
+        with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+            baselines = json.load(f)
+
+    for _ in range(args.retries if baselines or args.update_baseline else 0):
+        if not args.update_baseline:
+            regressions, _ = compare(results, baselines, args.threshold, verbose=False)
+            if not regressions:
+                break
+            print(f"遅くなった処理があるので測り直します: {', '.join(regressions)}")
+        # 基準値も比較も、各処理について速かった方の回を使う
+        again = run_all(sizes, args.archive_max)
+        results = {key: min(value, again.get(key, value)) for key, value in results.items()}
+
+    regressions, missing = compare(results, baselines, args.threshold)
+
+    if args.update_baseline:
+        baselines.update(results)
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+        print(f"基準値を更新しました: {BASELINE_PATH}")
+        return 0
+
+    if not baselines:
+        print(
+            f"基準値がありません: {BASELINE_PATH}\n"
+            "python -m benchmarks.bench_core --update-baseline で作成してください。"
+        )
+        return 2
+    if missing:
+        print(f"警告: 基準値が無いため比較していない処理: {', '.join(missing)}")
+
+    if regressions:
+        print(f"基準値より {args.threshold:.0%} を超えて遅くなった処理: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
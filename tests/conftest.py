@@ -0,0 +1,88 @@
+# テスト共通の設定・フィクスチャ
+import os
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# llm_connector は import 時に API キーを要求する（テストでは通信しない）
+os.environ.setdefault("GEMINI_API_KEY", "test")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+class FakeClock:
+    """呼ぶと now を返す時計。テストから now を進める。"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+# /game で出す選択肢（作品はすべて別）
+OPTIONS = [
+    {"text": "メロスは激怒した。", "next_mood": "angry", "work_id": "hashire"},
+    {"text": "檸檬を置いた。", "next_mood": "calm", "work_id": "lemon"},
+    {"text": "先生と呼んでいた。", "next_mood": "melancholic", "work_id": "kokoro"},
+]
+
+
+class FakeScenes:
+    """
+    generate_scene の代わり。呼び出しを (chosen_text, speculative) で記録する。
+    先読みの呼び出しだけ、遅らせたり（speculative_delay）失敗させたり（speculative_error）できる。
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.speculative_delay = 0.0
+        self.speculative_error = None
+
+    def __call__(self, chosen_text, *args, speculative=False):
+        self.calls.append((chosen_text, speculative))
+        if speculative:
+            time.sleep(self.speculative_delay)
+            if self.speculative_error is not None:
+                raise self.speculative_error
+        return f"{chosen_text}の続き。", {"totalTokenCount": 10}
+
+    @property
+    def direct(self):
+        """/choose から直接生成した chosen_text。"""
+        return [text for text, speculative in self.calls if not speculative]
+
+
+@pytest.fixture
+def app_env(tmp_path, monkeypatch):
+    """
+    app.main をテスト用に切り替える。物語の保存先・先読み・流量制御・モデル振り分け・
+    先読みの集計はテストごとに新しくし、LLM 呼び出しは偽物（options・FakeScenes）に置き換える。
+    """
+    from app import main as app_main
+    from app.core.admission import AdmissionController
+    from app.core.llm_connector import LATENCY_PRIORS, ROUTED_MODELS
+    from app.core.model_router import ModelRouter
+
+    monkeypatch.setattr(app_main, "SESSION_STORY_DIR", str(tmp_path))
+    monkeypatch.setattr(app_main, "SCENE_BACKEND", "gemini")
+    monkeypatch.setattr(app_main, "_speculations", {})
+    monkeypatch.setattr(app_main, "ADMISSION", AdmissionController())
+    monkeypatch.setattr(app_main, "model_router", ModelRouter(ROUTED_MODELS, priors=LATENCY_PRIORS))
+    monkeypatch.setattr(
+        app_main, "SPECULATION_STATS", {k: type(v)() for k, v in app_main.SPECULATION_STATS.items()}
+    )
+    monkeypatch.setattr(app_main, "generate_options_from_csv", lambda mood: [dict(o) for o in OPTIONS])
+    scenes = FakeScenes()
+    monkeypatch.setattr(app_main, "generate_scene", scenes)
+    app_main.app.config["TESTING"] = True
+    return SimpleNamespace(
+        main=app_main, client=app_main.app.test_client(), scenes=scenes, options=OPTIONS,
+    )
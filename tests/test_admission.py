@@ -0,0 +1,91 @@
+# 流量制御（先読みの別枠・セッションごとの上限）のテスト
+import time
+
+import pytest
+
+from app import main as app_main
+from app.core.admission import AdmissionController, Overloaded
+
+
+def test_speculation_does_not_count_toward_session_limit():
+    controller = AdmissionController(max_per_session=1, max_speculative_per_session=3)
+    slots = [controller.admit_speculative("s") for _ in range(3)]
+
+    with controller.admit("s"):
+        pass
+    with pytest.raises(Overloaded):
+        controller.admit_speculative("s")
+
+    # 捨てた先読みの枠は、呼び出しの完了を待たずに返せる（何度返してもよい）
+    for slot in slots:
+        slot.release()
+        slot.release()
+    controller.admit_speculative("s").release()
+    assert controller.snapshot()["speculative_active"] == 0
+    assert controller.shed == {"speculative_session_limit": 1}
+
+
+def test_detached_speculation_is_reported_until_it_finishes():
+    controller = AdmissionController(max_speculative=1)
+    slot = controller.admit_speculative("s")
+
+    # 捨てた先読みの枠は返すが、呼び出しが終わるまでは切り離し中として数える
+    slot.detach()
+    slot.detach()
+    assert controller.snapshot()["speculative_active"] == 0
+    assert controller.snapshot()["speculative_detached"] == 1
+    controller.admit_speculative("s").release()
+
+    slot.release()
+    slot.release()
+    snapshot = controller.snapshot()
+    assert snapshot["speculative_active"] == 0 and snapshot["speculative_detached"] == 0
+
+
+def test_speculative_pool_is_shared_across_sessions():
+    controller = AdmissionController(max_speculative=2)
+    controller.admit_speculative("a")
+    controller.admit_speculative("b")
+
+    with pytest.raises(Overloaded):
+        controller.admit_speculative("c")
+    # 先読みで埋まっていても、プレイヤーを待たせる呼び出しは通る
+    with controller.admit("c", wait=False):
+        pass
+
+
+@pytest.fixture
+def app_client(app_env):
+    # 先読みは /game を再読み込みするまで走り続ける
+    app_env.scenes.speculative_delay = 0.3
+    return app_env
+
+
+def test_reload_then_choose_is_not_shed(app_client):
+    option = app_client.options[1]
+    app_client.client.get("/start")
+    app_client.client.get("/game")
+    app_client.client.get("/game")  # 再読み込み：前の先読み 3 件はまだ走っている
+    snapshot = app_main.ADMISSION.snapshot()
+    assert snapshot["speculative_active"] == 3 and snapshot["speculative_detached"] == 3
+    rsp = app_client.client.post("/choose", data={
+        "chosen_text": option["text"],
+        "selected_mood": option["next_mood"],
+        "current_work": option["work_id"],
+    })
+
+    assert rsp.status_code == 302
+    assert app_main.ADMISSION.shed == {}
+    with app_client.client.session_transaction() as sess:
+        story = app_main.load_story(sess["story_id"])["story"]
+    assert story == ["檸檬を置いた。の続き。"]
+    assert app_client.scenes.direct == []  # 先読みの結果を使った
+
+    # 再読み込みで捨てた先読みが走り終わっても、枠が二重に返らないこと
+    deadline = time.monotonic() + 5
+    while app_main.ADMISSION.snapshot()["speculative_active"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.4)
+    snapshot = app_main.ADMISSION.snapshot()
+    assert snapshot["active"] == 0 and snapshot["speculative_active"] == 0
+    assert snapshot["speculative_detached"] == 0
@@ -0,0 +1,255 @@
+# コンテキストキャッシュ（登録・再利用・期限切れ・登録し直し）のテスト
+# cachedContents の代わりに、期限つきでハンドルを発行する偽のサーバーを使う。
+import datetime
+import json
+import threading
+from types import SimpleNamespace
+
+import google.generativeai as genai
+import pytest
+from google.generativeai import caching
+
+from app import main as app_main
+from app.core import context_cache as cc
+from app.core import llm_connector
+from app.core.model_router import ModelRouter
+
+LONG_PROMPT = "静的な指示文。" * 200
+
+
+class FakeCachedContents:
+    """create(model, text, ttl) でキャッシュ名を発行し、期限まで有効とする。"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.entries = {}
+        self.created = []
+
+    def create(self, model, text, ttl):
+        name = f"cachedContents/{len(self.created)}"
+        self.created.append((model, text, ttl))
+        self.entries[name] = self.clock() + ttl
+        return name
+
+    def is_valid(self, name):
+        return name in self.entries and self.clock() < self.entries[name]
+
+
+@pytest.fixture
+def server(clock):
+    server = FakeCachedContents(clock)
+    cache = cc.ContextCache(server.create, ttl=600, enabled=True, clock=clock, min_tokens=100)
+    return SimpleNamespace(clock=clock, server=server, cache=cache)
+
+
+def test_registers_once_and_reuses(server):
+    first = server.cache.get("lite", "scene", LONG_PROMPT)
+    second = server.cache.get("lite", "scene", LONG_PROMPT)
+
+    assert first == second
+    assert server.server.is_valid(first)
+    assert len(server.server.created) == 1
+    # モデルが違えば別に登録する
+    assert server.cache.get("rich", "scene", LONG_PROMPT) != first
+
+
+def test_refreshes_before_expiry(server):
+    first = server.cache.get("lite", "scene", LONG_PROMPT)
+
+    server.clock.now += 600 - cc.REFRESH_MARGIN_SECONDS
+    second = server.cache.get("lite", "scene", LONG_PROMPT)
+
+    assert second != first
+    assert server.server.is_valid(second)
+    assert server.cache.snapshot()["registrations"] == 2
+
+
+def test_invalidated_handle_is_registered_again(server):
+    first = server.cache.get("lite", "scene", LONG_PROMPT)
+    server.server.entries.clear()  # サーバー側で削除された
+    server.cache.invalidate("lite", "scene")
+
+    second = server.cache.get("lite", "scene", LONG_PROMPT)
+    assert second != first and server.server.is_valid(second)
+
+
+def test_short_prompt_is_not_registered(server):
+    assert server.cache.get("lite", "scene", "短い指示。") is None
+    assert server.server.created == []
+    assert server.cache.snapshot()["skipped_small"] == 1
+
+
+def test_failure_backs_off(server):
+    def fail(model, text, ttl):
+        raise RuntimeError("too small")
+
+    server.cache.create_fn = fail
+    assert server.cache.get("lite", "scene", LONG_PROMPT) is None
+
+    server.cache.create_fn = server.server.create
+    assert server.cache.get("lite", "scene", LONG_PROMPT) is None
+    server.clock.now += cc.FAILURE_BACKOFF_SECONDS
+    assert server.cache.get("lite", "scene", LONG_PROMPT) is not None
+
+
+def test_registration_runs_outside_the_lock(server):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_create(model, text, ttl):
+        started.set()
+        release.wait(5)
+        return server.server.create(model, text, ttl)
+
+    server.cache.create_fn = slow_create
+    results = []
+    worker = threading.Thread(
+        target=lambda: results.append(server.cache.get("lite", "scene", LONG_PROMPT))
+    )
+    worker.start()
+    assert started.wait(5)
+
+    # 登録中でも記録や他の呼び出しは止まらず、同じキーを二重に登録しない
+    server.cache.record(cached=False, prompt_tokens=10, cached_tokens=0, seconds=0.1)
+    assert server.cache.get("lite", "scene", LONG_PROMPT) is None
+    release.set()
+    worker.join(5)
+
+    assert len(server.server.created) == 1
+    assert results == [server.cache.get("lite", "scene", LONG_PROMPT)]
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+
+def test_generate_scene_uses_and_recovers_cache(server, monkeypatch):
+    """generate_scene が登録済みキャッシュを参照し、期限切れなら登録し直すこと。"""
+    sent = []
+
+    def fake_post(url, json, timeout):
+        if url.startswith(app_main.CACHED_CONTENTS_URL):
+            name = server.server.create(json["model"], json["systemInstruction"], 600)
+            return FakeResponse(200, {"name": name})
+        sent.append(json)
+        name = json.get("cachedContent")
+        if name and not server.server.is_valid(name):
+            return FakeResponse(404, {})
+        usage = {"promptTokenCount": 1200, "cachedContentTokenCount": 1000 if name else 0}
+        return FakeResponse(200, {
+            "candidates": [{"content": {"parts": [{"text": "メロスは走った。"}]}}],
+            "usageMetadata": usage,
+        })
+
+    monkeypatch.setattr(app_main.requests, "post", fake_post)
+    monkeypatch.setattr(app_main, "model_router", ModelRouter(["lite"], clock=server.clock))
+    monkeypatch.setattr(server.cache, "create_fn", app_main.create_scene_cache)
+    server.cache.min_tokens = 1
+    monkeypatch.setattr(app_main, "scene_cache", server.cache)
+    args = ("檸檬", "calm", "孤独", "檸檬", 1, "")
+
+    assert app_main.generate_scene(*args)[0] == "メロスは走った。"
+    assert app_main.generate_scene(*args)[0] == "メロスは走った。"
+    assert [("cachedContent" in p) for p in sent] == [True, True]
+    assert "systemInstruction" not in sent[0]
+
+    # サーバー側で期限切れ → その回は失敗して無効化、次の回で登録し直す
+    server.server.entries.clear()
+    with pytest.raises(RuntimeError):
+        app_main.generate_scene(*args)
+    assert app_main.generate_scene(*args)[0] == "メロスは走った。"
+    assert len(server.server.created) == 2
+    assert server.cache.snapshot()["cached"]["cached_tokens"] == 3000
+
+    # キャッシュなしでも、可変部分は同じ user ターンで送り、system 指示は SCENE_RULES だけ
+    server.cache.enabled = False
+    app_main.generate_scene(*args)
+    assert sent[-1]["contents"] == sent[0]["contents"]
+    assert sent[-1]["systemInstruction"] == {"parts": [{"text": app_main.SCENE_RULES}]}
+    assert "檸檬" in sent[0]["contents"][0]["parts"][0]["text"]
+
+
+class FakeGenerativeModel:
+    """GenerativeModel の代わり。受け取った contents を記録し、quote_id を 3 つ返す。"""
+
+    def __init__(self, quote_ids, cached_tokens=0):
+        self.quote_ids = quote_ids
+        self.cached_tokens = cached_tokens
+        self.contents = []
+        self.fail = False
+
+    def generate_content(self, contents):
+        self.contents.append(contents)
+        if self.fail:
+            raise RuntimeError("404 CachedContent not found")
+        options = [{"quote_id": q, "next_mood": "calm"} for q in self.quote_ids]
+        return SimpleNamespace(
+            text=json.dumps({"options": options}),
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=1200, cached_content_token_count=self.cached_tokens,
+            ),
+        )
+
+
+def test_options_use_and_recover_sdk_cache(clock, monkeypatch):
+    """generate_options_from_csv が SDK の cachedContents を使い、失敗したら登録し直すこと。"""
+    quote_ids = list(llm_connector._compact_quotes()[0])[:3]
+    plain = FakeGenerativeModel(quote_ids)
+    created, cached_models = [], []
+
+    def fake_create(**kwargs):
+        created.append(kwargs)
+        return f"cachedContents/{len(created)}"
+
+    def fake_from_cached_content(cached_content):
+        model = FakeGenerativeModel(quote_ids, cached_tokens=1000)
+        model.cached_content = cached_content
+        cached_models.append(model)
+        return model
+
+    monkeypatch.setattr(caching.CachedContent, "create", staticmethod(fake_create))
+    monkeypatch.setattr(
+        genai.GenerativeModel, "from_cached_content", staticmethod(fake_from_cached_content)
+    )
+    monkeypatch.setattr(llm_connector, "_get_model", lambda name: plain)
+    monkeypatch.setattr(llm_connector, "model_router", ModelRouter(["lite"], clock=clock))
+    cache = cc.ContextCache(
+        llm_connector._create_cached_model, ttl=600, enabled=True, clock=clock, min_tokens=1,
+    )
+    monkeypatch.setattr(llm_connector, "options_cache", cache)
+
+    options = llm_connector.generate_options_from_csv("calm")
+    assert [o["quote_id"] for o in options] == quote_ids
+    assert created == [{
+        "model": "models/lite",
+        "system_instruction": llm_connector.SYSTEM_MSG,
+        "ttl": datetime.timedelta(seconds=600),
+    }]
+    # 登録済みなら SYSTEM_MSG は送らず、可変部分（user ターン 1 つ）だけ
+    [contents] = cached_models[0].contents
+    assert len(contents) == 1
+    assert llm_connector.SYSTEM_MSG not in contents[0]["parts"][0]["text"]
+
+    # 期限切れ等で失敗したら無効化し、次の回で登録し直す
+    cached_models[0].fail = True
+    with pytest.raises(RuntimeError):
+        llm_connector.generate_options_from_csv("calm")
+    llm_connector.generate_options_from_csv("calm")
+    assert len(created) == 2 and cached_models[1].cached_content == "cachedContents/2"
+    assert cache.snapshot()["cached"]["cached_tokens"] == 2000
+
+    # キャッシュなしなら SYSTEM_MSG を先頭に付けて送る
+    cache.enabled = False
+    llm_connector.generate_options_from_csv("calm")
+    [contents] = plain.contents
+    assert contents[0]["parts"][0]["text"] == llm_connector.SYSTEM_MSG
+    assert len(contents) == 2
@@ -0,0 +1,108 @@
+# オフライン用のローカル文章生成（長さ・改行・作品ごとの確率表・作り直し）のテスト
+import os
+import random
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from app import main as app_main
+from app.core import local_generator as lg
+
+WORKS = {work_id: [v["text"]] for work_id, v in app_main.SYNOPSIS_DATA.items()}
+
+
+@pytest.fixture
+def generator(tmp_path):
+    return lg.LocalSceneGenerator(WORKS, path=tmp_path / "markov.bin")
+
+
+def scenes(generator, chosen_text="", work=None, n=50):
+    return [generator.generate(chosen_text, work=work, rng=random.Random(seed)) for seed in range(n)]
+
+
+@pytest.mark.parametrize("chosen_text", ["", "メロスは激怒した。", "長い台詞。" * 50])
+def test_length_stays_within_limits(generator, chosen_text):
+    # 200 文字を超える台詞を選んでも上限を超えない
+    for text in scenes(generator, chosen_text, work="hashire"):
+        assert lg.MIN_CHARS <= len(text.replace("\n", "")) <= lg.MAX_CHARS
+
+
+def test_every_period_is_followed_by_a_newline(generator):
+    for text in scenes(generator, "檸檬を置いた。", work="lemon"):
+        # 末尾の句点は LLM の文章（strip 済み）と同じく改行なしで終わる
+        assert text.endswith("。")
+        assert re.search("。(?!\n|$)", text) is None
+
+
+def test_long_chosen_text_is_shortened(generator):
+    chosen_text = "あ" * 250
+    text = generator.generate(chosen_text, work="hashire", rng=random.Random(0))
+
+    assert text.startswith(f"メロスは「{'あ' * (lg.MAX_QUOTE_CHARS - 1)}…」と叫んだ。\n")
+
+
+def test_each_work_uses_only_its_own_texts(generator):
+    # 他の作品の固有名詞・モチーフ
+    others = {"メロス", "セリヌンティウス", "先生", "山猫"}
+    for text in scenes(generator, work="lemon"):
+        assert not any(word in text for word in others), text
+
+    assert generator.table_path("lemon").exists()
+    assert not generator.table_path(None).exists()
+    # 未知の作品（題名など）は全作品の表を使う
+    generator.generate("", work="走れメロス")
+    assert generator.table_path(None).exists()
+
+
+def test_table_is_rebuilt_when_the_corpus_changes(tmp_path, monkeypatch):
+    compiled = []
+    compile_table = lg.compile_table
+    monkeypatch.setattr(
+        lg, "compile_table", lambda texts, path: compiled.append(path) or compile_table(texts, path)
+    )
+    path = tmp_path / "markov.bin"
+
+    lg.LocalSceneGenerator(WORKS, path=path).generate("", work="kokoro")
+    lg.LocalSceneGenerator(WORKS, path=path).generate("", work="kokoro")
+    assert len(compiled) == 1  # 同じ学習データなら書き出し済みの表を使う
+
+    changed = dict(WORKS, kokoro=WORKS["kokoro"] + ["先生は海辺で静かに笑った。"])
+    lg.LocalSceneGenerator(changed, path=path).generate("", work="kokoro")
+    assert compiled == [path.with_name("markov-kokoro.bin")] * 2
+
+
+def test_local_backend_starts_without_an_api_key():
+    root = Path(__file__).resolve().parents[1]
+    env = {k: v for k, v in os.environ.items() if k != "GEMINI_API_KEY"}
+    env["SCENE_BACKEND"] = "local"
+    result = subprocess.run(
+        [sys.executable, "-c", "import app.main"], cwd=root, env=env, capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_local_backend_does_not_call_the_llm(app_env, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_main, "SCENE_BACKEND", "local")
+    generator = lg.LocalSceneGenerator(WORKS, path=tmp_path / "markov.bin")
+    monkeypatch.setattr(app_main, "LOCAL_GENERATOR", generator)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("LLM を呼んではいけない")
+
+    monkeypatch.setattr(app_main, "generate_options_from_csv", fail)
+    app_env.client.get("/start")
+    assert app_env.client.get("/game").status_code == 200
+    rsp = app_env.client.post("/choose", data={
+        "chosen_text": "檸檬を置いた。", "selected_mood": "calm", "current_work": "lemon",
+    })
+
+    assert rsp.status_code == 302
+    assert app_env.scenes.calls == []
+    assert app_main.ADMISSION.snapshot()["admitted"] == 0
+    with app_env.client.session_transaction() as sess:
+        [scene] = app_main.load_story(sess["story_id"])["story"]
+    assert scene.startswith("メロスは「檸檬を置いた」と叫んだ。\n")
+    assert "メロス" not in scene[len("メロスは"):] and "セリヌンティウス" not in scene
@@ -0,0 +1,131 @@
+# モデル振り分け（許容時間・試しの呼び出し・事前値）のテスト
+# 実際の API の代わりに、応答時間を決めた偽のモデルを使う。
+import pytest
+
+from app.core import model_router as mr
+
+RICH = "rich"
+LITE = "lite"
+
+
+class FakeProvider:
+    """モデル名 → 応答時間（秒）・失敗するかどうか。呼ぶと時計を進める。"""
+
+    def __init__(self, clock, latency, failing=()):
+        self.clock = clock
+        self.latency = dict(latency)
+        self.failing = set(failing)
+        self.calls = []
+
+    def __call__(self, model):
+        self.calls.append(model)
+        self.clock.now += self.latency[model]
+        if model in self.failing:
+            raise RuntimeError(f"{model} failed")
+        return model
+
+
+def test_fast_rich_model_is_preferred(clock):
+    router = mr.ModelRouter([RICH, LITE], clock=clock)
+    provider = FakeProvider(clock, {RICH: 2.0, LITE: 1.0})
+
+    for _ in range(5):
+        router.call("scene", provider)
+
+    assert provider.calls == [RICH] * 5
+
+
+def test_slow_model_is_dropped_and_probed_once(clock):
+    router = mr.ModelRouter([RICH, LITE], clock=clock)
+    provider = FakeProvider(clock, {RICH: 12.0, LITE: 1.0})
+
+    router.call("scene", provider)
+    for _ in range(3):
+        router.call("scene", provider)
+    assert provider.calls == [RICH, LITE, LITE, LITE]
+
+    # RETRY_AFTER 経つと試しは 1 回だけ。戻る前に来た呼び出しは軽いモデルへ
+    clock.now += mr.RETRY_AFTER
+    chosen = [router.choose("scene") for _ in range(10)]
+    assert chosen == [RICH] + [LITE] * 9
+
+    # 試しがまだ遅ければ、また RETRY_AFTER の間は使わない
+    router.record("scene", RICH, 12.0, ok=True)
+    assert router.choose("scene") == LITE
+
+
+def test_probe_that_never_returns_is_retried_after_timeout(clock):
+    router = mr.ModelRouter([RICH, LITE], clock=clock)
+    router.record("scene", RICH, 12.0, ok=True)
+
+    clock.now += mr.RETRY_AFTER
+    assert router.choose("scene") == RICH
+    assert router.choose("scene") == LITE
+
+    clock.now += mr.PROBE_TIMEOUT
+    assert router.choose("scene") == RICH
+
+
+def test_failing_model_recovers_after_a_single_probe(clock):
+    router = mr.ModelRouter([RICH, LITE], clock=clock)
+    provider = FakeProvider(clock, {RICH: 1.0, LITE: 1.0}, failing={RICH})
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            router.call("scene", provider)
+    assert provider.calls == [RICH, RICH]
+    assert router.choose("scene") == LITE
+
+    clock.now += mr.RETRY_AFTER
+    assert [router.choose("scene") for _ in range(5)] == [RICH] + [LITE] * 4
+
+    # 試しが成功したら再び使う
+    router.record("scene", RICH, 1.0, ok=True)
+    router.record("scene", RICH, 1.0, ok=True)
+    assert router.choose("scene") == RICH
+
+
+def test_priors_keep_options_on_the_light_model(clock):
+    router = mr.ModelRouter(
+        [RICH, LITE], clock=clock, priors={"options": {RICH: 8.0}},
+    )
+    provider = FakeProvider(clock, {RICH: 3.0, LITE: 1.0})
+
+    router.call("options", provider)
+    router.call("scene", provider)
+    assert provider.calls == [LITE, RICH]
+
+    # 実測で許容時間に収まると分かれば、重いモデルに移る
+    clock.now += mr.RETRY_AFTER
+    router.call("options", provider)
+    router.call("options", provider)
+    assert provider.calls[2:] == [RICH, RICH]
+
+
+def test_scene_latency_does_not_affect_options(clock):
+    router = mr.ModelRouter([RICH, LITE], clock=clock)
+    router.record("scene", RICH, 7.0, ok=True)
+
+    assert router.choose("scene") == RICH
+    assert router.choose("options") == RICH
+    router.record("options", RICH, 7.0, ok=True)
+    assert router.choose("options") == LITE
+
+
+def test_speculative_calls_do_not_degrade_the_model(clock):
+    router = mr.ModelRouter([RICH, LITE], clock=clock)
+
+    def nested(speculative):
+        # 呼び出し中にさらに呼び出して、同時呼び出しを DEGRADE_PER_INFLIGHT 件まで積む
+        def fn(model):
+            if router.inflight + router.speculative_inflight < mr.DEGRADE_PER_INFLIGHT:
+                return router.call("scene", fn, speculative=speculative)
+            return router.choose("scene")
+        return router.call("scene", fn, speculative=speculative)
+
+    # 先読みがいくつ走っていても、プレイヤーを待たせる呼び出しは重いモデルのまま
+    assert nested(speculative=True) == RICH
+    # 先読みでない呼び出しは数える
+    assert nested(speculative=False) == LITE
+    snapshot = router.snapshot()
+    assert snapshot["inflight"] == 0 and snapshot["speculative_inflight"] == 0
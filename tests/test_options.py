@@ -0,0 +1,38 @@
+# 選択肢の展開（quote_id の重複・不足の補充）のテスト
+import pytest
+
+from app.core import llm_connector
+
+
+@pytest.fixture
+def quote_ids():
+    quotes_by_id, _, _ = llm_connector._compact_quotes()
+    return list(quotes_by_id)
+
+
+def test_three_valid_ids_are_expanded(quote_ids):
+    options = llm_connector._expand_options(
+        [{"quote_id": q, "next_mood": "calm"} for q in quote_ids[:3]]
+    )
+
+    assert [o["quote_id"] for o in options] == quote_ids[:3]
+    assert [o["id"] for o in options] == [1, 2, 3]
+    assert all(o["text"] and o["next_mood"] == "calm" for o in options)
+
+
+def test_duplicates_and_unknown_ids_are_filled_to_three(quote_ids):
+    options = llm_connector._expand_options(
+        [{"quote_id": quote_ids[0]}, {"quote_id": quote_ids[0]}, {"quote_id": "999999"}],
+        "hopeful",
+    )
+
+    assert len(options) == 3
+    assert options[0]["quote_id"] == quote_ids[0]
+    assert len({o["quote_id"] for o in options}) == 3
+    assert [o["id"] for o in options] == [1, 2, 3]
+    assert all(o["text"] for o in options)
+
+
+def test_no_valid_ids_raises():
+    with pytest.raises(ValueError):
+        llm_connector._expand_options([{"quote_id": "999999"}])
@@ -0,0 +1,86 @@
+# プレイヤーごとの物語ファイル（/api/story・期限切れの削除）のテスト
+import os
+import time
+
+import pytest
+
+from app import main as app_main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_main, "SESSION_STORY_DIR", str(tmp_path))
+    app_main.app.config["TESTING"] = True
+    return app_main.app.test_client()
+
+
+def test_story_without_start_gets_its_own_id(client, tmp_path):
+    rsp = client.get("/api/story")
+
+    assert rsp.status_code == 200
+    assert rsp.get_json()["story"] == []
+    with client.session_transaction() as sess:
+        story_id = sess["story_id"]
+    assert app_main.is_valid_story_id(story_id)
+
+    # 2 回目も同じ ID を使う
+    client.get("/api/story")
+    with client.session_transaction() as sess:
+        assert sess["story_id"] == story_id
+
+
+def test_invalid_story_id_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_main, "SESSION_STORY_DIR", str(tmp_path))
+    with pytest.raises(ValueError):
+        app_main.load_story("../static/data/story")
+
+
+def test_old_session_stories_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_main, "SESSION_STORY_DIR", str(tmp_path))
+    app_main.save_story({"story": ["古い"]}, "0" * 16)
+    app_main.save_story({"story": ["新しい"]}, "1" * 16)
+    old = time.time() - app_main.SESSION_STORY_TTL - 10
+    os.utime(tmp_path / f"{'0' * 16}.json", (old, old))
+
+    assert app_main.cleanup_session_stories() == 1
+    assert app_main.load_story("0" * 16) == {"story": []}
+    assert app_main.load_story("1" * 16) == {"story": ["新しい"]}
+
+
+@pytest.fixture
+def story_client(client):
+    """3 段落の物語を持つセッション。"""
+    with client.session_transaction() as sess:
+        sess["story_id"] = "c" * 16
+    app_main.save_story({"story": ["一。", "二。", "三。"]}, "c" * 16)
+    return client
+
+
+def test_since_returns_only_new_paragraphs(story_client):
+    body = story_client.get("/api/story?since=1").get_json()
+
+    assert body == {"since": 1, "total": 3, "reset": False, "story": ["二。", "三。"]}
+
+
+def test_since_past_the_end_resets(story_client):
+    body = story_client.get("/api/story?since=5").get_json()
+
+    assert body["reset"] is True
+    assert body["since"] == 0
+    assert body["story"] == ["一。", "二。", "三。"]
+
+
+def test_matching_etag_returns_304(story_client):
+    first = story_client.get("/api/story?since=0")
+    assert first.headers["Cache-Control"] == "private, no-cache"
+    etag = first.headers["ETag"]
+
+    second = story_client.get("/api/story?since=0", headers={"If-None-Match": etag})
+    assert second.status_code == 304
+    assert second.data == b""
+
+    # 段落が増えれば ETag も変わる
+    app_main.save_story({"story": ["一。", "二。", "三。", "四。"]}, "c" * 16)
+    third = story_client.get("/api/story?since=0", headers={"If-None-Match": etag})
+    assert third.status_code == 200
+    assert third.get_json()["total"] == 4
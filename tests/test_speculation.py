@@ -0,0 +1,103 @@
+# 先読み生成（期限切れの破棄・詰まっているとき・失敗したときの直接生成）のテスト
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app import main as app_main
+
+
+@pytest.fixture
+def speculation(app_env, monkeypatch):
+    # 先読み用のスレッドは 1 本（テストから塞げるように）
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(app_main, "SPECULATION_EXECUTOR", executor)
+    yield app_env
+    executor.shutdown(wait=True, cancel_futures=True)
+
+
+def choose(env, story_id, option):
+    with env.client.session_transaction() as sess:
+        sess["story_id"] = story_id
+        sess["turn"] = 1
+    return env.client.post("/choose", data={
+        "chosen_text": option["text"],
+        "selected_mood": option["next_mood"],
+        "current_work": option["work_id"],
+    })
+
+
+def wait_for_speculations(story_id):
+    for future in list(app_main._speculations[story_id]["futures"].values()):
+        try:
+            future.result(timeout=5)
+        except Exception:
+            pass
+
+
+def test_abandoned_speculations_expire(speculation):
+    app_main.start_speculation("a" * 16, 1, speculation.options, "")
+    created = app_main._speculations["a" * 16]["created"]
+
+    with app_main._speculation_lock:
+        assert app_main._expire_speculations(now=created + 1) == 0
+        assert app_main._expire_speculations(now=created + app_main.SPECULATION_TTL + 1) == 1
+    assert app_main._speculations == {}
+
+
+def test_queued_speculation_is_cancelled_and_generated_directly(speculation):
+    # 先読み用のスレッドを塞いで、先読みが待ち行列に残ったままにする
+    release = threading.Event()
+    app_main.SPECULATION_EXECUTOR.submit(release.wait)
+    option = speculation.options[0]
+    app_main.start_speculation("b" * 16, 1, speculation.options, "")
+
+    start = time.monotonic()
+    rsp = choose(speculation, "b" * 16, option)
+    release.set()
+
+    assert rsp.status_code == 302
+    assert time.monotonic() - start < app_main.SCENE_TIMEOUT
+    assert speculation.scenes.calls == [(option["text"], False)]
+    assert app_main.load_story("b" * 16)["story"] == ["メロスは激怒した。の続き。"]
+
+
+def test_failed_speculation_is_generated_directly(speculation):
+    speculation.scenes.speculative_error = RuntimeError("HTTP 500")
+    option = speculation.options[1]
+    app_main.start_speculation("c" * 16, 1, speculation.options, "")
+    wait_for_speculations("c" * 16)
+
+    rsp = choose(speculation, "c" * 16, option)
+
+    assert rsp.status_code == 302
+    # 代わりの文章ではなく、LLM で生成し直した文章
+    assert speculation.scenes.direct == [option["text"]]
+    assert app_main.load_story("c" * 16)["story"] == ["檸檬を置いた。の続き。"]
+    assert app_main.SPECULATION_STATS["failed"] == 1
+    # 先読み 3 件 + 直接生成 1 件（プレイヤーを待たせる枠で）
+    assert app_main.ADMISSION.snapshot()["admitted"] == len(speculation.options) + 1
+
+
+def test_timed_out_speculation_is_generated_directly_and_counted(speculation, monkeypatch):
+    monkeypatch.setattr(app_main, "SCENE_TIMEOUT", 0.1)
+    speculation.scenes.speculative_delay = 0.3
+    option = speculation.options[0]
+    # 選ばれたもの以外は待ち行列に残して取り消させる（最初の 1 件だけ走る）
+    app_main.start_speculation("d" * 16, 1, speculation.options, "")
+    future = app_main._speculations["d" * 16]["futures"][
+        (option["text"], option["next_mood"], option["work_id"])
+    ]
+
+    rsp = choose(speculation, "d" * 16, option)
+
+    assert rsp.status_code == 302
+    assert speculation.scenes.direct == [option["text"]]
+    assert app_main.load_story("d" * 16)["story"] == ["メロスは激怒した。の続き。"]
+    assert app_main.SPECULATION_STATS["failed"] == 1
+
+    # 時間切れの先読みが後から終わったら、そのトークンは無駄として数える
+    future.result(timeout=5)
+    assert app_main.SPECULATION_STATS["wasted_tokens"] == 10
+    assert app_main.SPECULATION_STATS["used_tokens"] == 0
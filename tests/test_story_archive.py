@@ -0,0 +1,81 @@
+# 物語アーカイブ（重複排除・ページ分け・ID の検証）のテスト
+import pytest
+
+from app.core import story_archive
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    story_archive.close()
+    monkeypatch.setattr(story_archive, "ARCHIVE_DIR", tmp_path)
+    monkeypatch.setattr(story_archive, "DB_PATH", tmp_path / "archive.sqlite3")
+    yield story_archive
+    story_archive.close()
+
+
+def test_same_story_is_stored_once(archive):
+    story = ["メロスは走った。\n友との約束を守るために。"]
+    first = archive.archive_story(story, "hopeful", ["hashire"])
+    second = archive.archive_story(story, "calm", ["kokoro"])
+
+    assert first == second
+    assert archive.load_archived_story(first) == {"story": story}
+    assert archive.list_archived_stories()["total"] == 1
+
+
+def test_listing_is_paged_by_mood_and_work(archive):
+    for i in range(7):
+        archive.archive_story([f"場面{i}。"], "calm", ["lemon" if i % 2 else "kokoro"])
+
+    page = archive.list_archived_stories(mood="calm", work="kokoro", limit=3)
+    assert page["total"] == 4
+    assert len(page["stories"]) == 3
+    assert page["next_offset"] == 3
+
+    rest = archive.list_archived_stories(mood="calm", work="kokoro", offset=3, limit=3)
+    assert len(rest["stories"]) == 1
+    assert rest["next_offset"] is None
+
+    # 開き直しても同じ結果になる
+    archive.close()
+    assert archive.list_archived_stories(mood="calm", work="kokoro")["total"] == 4
+    assert archive.list_archived_stories(work="lemon")["total"] == 3
+    assert archive.list_archived_stories(mood="calm")["total"] == 7
+
+
+@pytest.mark.parametrize("bad_id", ["../../etc/passwd", "0123", "ABCDEF0123456789", ""])
+def test_invalid_ids_are_rejected(archive, bad_id):
+    assert not archive.is_valid_story_id(bad_id)
+    assert archive.load_archived_story(bad_id) is None
+
+
+def test_stories_share_one_file_and_stats_count_blocks(archive, tmp_path):
+    for i in range(50):
+        archive.archive_story([f"場面{i}。\nメロスは走った。"], "calm", ["hashire"])
+
+    assert [p.name for p in tmp_path.iterdir() if p.is_dir()] == []
+    stats = archive.archive_stats()
+    assert stats["count"] == 50
+    # 割り当てられたブロックで数える（見かけのファイルサイズではなく）
+    assert stats["disk_bytes"] % 512 == 0 and stats["disk_bytes"] > 0
+
+
+def test_dictionary_mismatch_is_reported(archive, monkeypatch):
+    digest = archive.archive_story(["メロスは走った。"], "calm", ["hashire"])
+
+    monkeypatch.setattr(archive, "_zdict", b"other dictionary")
+    monkeypatch.setattr(archive, "_zdict_id", "00000000")
+    with pytest.raises(archive.ArchiveDictionaryError):
+        archive.load_archived_story(digest)
+
+
+def test_api_reports_dictionary_mismatch(archive, monkeypatch):
+    from app import main as app_main
+
+    digest = archive.archive_story(["メロスは走った。"], "calm", ["hashire"])
+    monkeypatch.setattr(archive, "_zdict", b"other dictionary")
+    monkeypatch.setattr(archive, "_zdict_id", "00000000")
+
+    rsp = app_main.app.test_client().get(f"/api/archive/{digest}")
+    assert rsp.status_code == 500
+    assert "辞書" in rsp.get_json()["error"]